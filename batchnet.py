@@ -0,0 +1,132 @@
+# Runs a whole population of neat FeedForwardNetworks at once with NumPy, instead of calling
+# activate on each network one node at a time. Every network is "compiled" into layers
+# (nodes whose inputs have all been calculated already), and each layer is calculated for every
+# network at the same time. Networks with fewer nodes or connections are padded out with
+# connections that have a weight of 0, so they all fit in the same arrays.
+
+import numpy as np
+from typing import List
+from neat.nn import FeedForwardNetwork
+from neat import activations, aggregations
+
+# NumPy versions of neat's activation functions. Networks using anything not in here still
+# work, they just get run with activate instead. (NumPy and math round tanh() and exp() slightly
+# differently, so outputs can be off from activate's in the last digit or so, but they match
+# within floating-point tolerance.)
+ACTIVATIONS = {
+    activations.tanh_activation: lambda z: np.tanh(np.clip(2.5 * z, -60.0, 60.0)),
+    activations.sigmoid_activation: lambda z: 1.0 / (1.0 + np.exp(-np.clip(5.0 * z, -60.0, 60.0))),
+    activations.relu_activation: lambda z: np.where(z > 0.0, z, 0.0),
+    activations.identity_activation: lambda z: z,
+    activations.clamped_activation: lambda z: np.clip(z, -1.0, 1.0),
+}
+
+
+# One layer of nodes for every network. Arrays have one row per network, one column per node
+# in the layer, and (for the connections) one entry per connection into the node.
+class BatchLayer:
+    def __init__(self, targets:np.ndarray, sources:np.ndarray, weights:np.ndarray, biases:np.ndarray,
+                responses:np.ndarray, activation_ids:np.ndarray) -> None:
+        self.targets = targets
+        self.sources = sources
+        self.weights = weights
+        self.biases = biases
+        self.responses = responses
+        self.activation_ids = activation_ids
+
+
+class BatchNetwork:
+    def __init__(self, nets:List[FeedForwardNetwork]) -> None:
+        self.nets = nets
+        self.input_count = len(nets[0].input_nodes) if nets else 0
+        self.output_count = len(nets[0].output_nodes) if nets else 0
+        self.compiled = np.array([self.__can_compile(net) for net in nets], dtype=bool)
+
+        # Each network's node values are stored in a row of an array. The inputs come first,
+        # then the outputs, then the hidden nodes. The last two columns are extra: one that
+        # padding nodes write their values into, and one that's always 0 for padding connections.
+        columns = []
+        depths = []
+        for net, compiled in zip(nets, self.compiled):
+            net_columns = {key: i for i, key in enumerate(net.input_nodes + net.output_nodes)}
+            net_depths = {key: 0 for key in net.input_nodes}
+            if compiled:
+                for node, _, _, _, _, links in net.node_evals:
+                    net_columns.setdefault(node, len(net_columns))
+                    net_depths[node] = 1 + max(net_depths[i] for i, _ in links)
+            columns.append(net_columns)
+            depths.append(net_depths)
+        self.scratch_column = max((len(i) for i in columns), default=0)
+        self.zero_column = self.scratch_column + 1
+        self.width = self.scratch_column + 2
+
+        self.activations = list({func for net, compiled in zip(nets, self.compiled) if compiled
+                                 for _, func, _, _, _, _ in net.node_evals})
+        self.layers = []
+        layer_count = max((max(i.values(), default=0) for i in depths), default=0)
+        for depth in range(1, layer_count + 1):
+            layer_nodes = [[node_eval for node_eval in net.node_evals if net_depths.get(node_eval[0]) == depth]
+                           if compiled else [] for net, net_depths, compiled in zip(nets, depths, self.compiled)]
+            self.layers.append(self.__build_layer(layer_nodes, columns))
+
+    # Networks can only be compiled if every node sums its inputs and uses a known activation function
+    def __can_compile(self, net:FeedForwardNetwork) -> bool:
+        return all(agg is aggregations.sum_aggregation and act in ACTIVATIONS
+                   for _, act, agg, _, _, _ in net.node_evals)
+
+    def __build_layer(self, layer_nodes:List, columns:List) -> BatchLayer:
+        count = len(layer_nodes)
+        width = max(len(i) for i in layer_nodes)
+        links = max((len(node_eval[5]) for nodes in layer_nodes for node_eval in nodes), default=0)
+
+        # Anything that isn't filled in is padding
+        targets = np.full((count, width), self.scratch_column)
+        sources = np.full((count, width, links), self.zero_column)
+        weights = np.zeros((count, width, links))
+        biases = np.zeros((count, width))
+        responses = np.zeros((count, width))
+        activation_ids = np.zeros((count, width), dtype=int)
+
+        for row, (nodes, net_columns) in enumerate(zip(layer_nodes, columns)):
+            for col, (node, act, _, bias, response, node_links) in enumerate(nodes):
+                targets[row, col] = net_columns[node]
+                biases[row, col] = bias
+                responses[row, col] = response
+                activation_ids[row, col] = self.activations.index(act)
+                for i, (source, weight) in enumerate(node_links):
+                    sources[row, col, i] = net_columns[source]
+                    weights[row, col, i] = weight
+
+        return BatchLayer(targets, sources, weights, biases, responses, activation_ids)
+
+    # Same as calling activate on each network. Takes an (M, inputs) array with one row for each
+    # network being run, plus which networks those are, and returns an (M, outputs) array.
+    def activate(self, inputs:np.ndarray, rows:np.ndarray) -> np.ndarray:
+        values = np.zeros((len(rows), self.width))
+        values[:, :self.input_count] = inputs
+        value_rows = np.arange(len(rows))[:, np.newaxis]
+
+        for layer in self.layers:
+            sources = layer.sources[rows]
+            weights = layer.weights[rows]
+            # Added up one connection at a time, in the same order activate does
+            total = np.zeros(sources.shape[:2])
+            for i in range(sources.shape[2]):
+                total = total + values[value_rows, sources[:, :, i]] * weights[:, :, i]
+            total = layer.biases[rows] + layer.responses[rows] * total
+
+            if len(self.activations) == 1:
+                result = ACTIVATIONS[self.activations[0]](total)
+            else:
+                activation_ids = layer.activation_ids[rows]
+                result = np.zeros_like(total)
+                for i, func in enumerate(self.activations):
+                    result = np.where(activation_ids == i, ACTIVATIONS[func](total), result)
+            values[value_rows, layer.targets[rows]] = result
+
+        outputs = values[:, self.input_count:self.input_count + self.output_count]
+
+        # Anything that couldn't be compiled gets run the normal way
+        for row in np.flatnonzero(~self.compiled[rows]):
+            outputs[row] = self.nets[rows[row]].activate(inputs[row].tolist())
+        return outputs
@@ -0,0 +1,170 @@
+# Measures how fast each part of the simulation runs, on every track and at a few different
+# population sizes, and writes the results to a JSON file so different versions can be compared.
+# Everything is seeded, so every run does exactly the same work. Nothing gets drawn.
+#
+# Usage: python benchmark.py [--populations 50 200 500] [--generations 3] [--seed 0] [--output benchmark.json]
+
+import argparse
+import json
+import platform
+import random
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+import neat
+from simulation import *
+
+# Each measurement keeps repeating until it's been running for at least this long (in seconds)
+MIN_TIME = 0.5
+
+# Calls a function over and over for at least MIN_TIME seconds, and returns how many units of work
+# got done per second. Each call does units_per_call units of work.
+def measure(function:Callable, units_per_call:int) -> float:
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < MIN_TIME:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return calls * units_per_call / elapsed
+
+# Random spots along the track's centerline (so they're inside the track), with random facing angles
+def sample_cars(track:Track, count:int, rng:np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    centerline = track.centerline
+    segments = rng.integers(len(centerline.points), size=count)
+    along = rng.uniform(0, 1, size=count)
+    positions = centerline.points[segments] + centerline.segment_vectors[segments] * along[:, np.newaxis]
+    return (positions, rng.uniform(-180, 180, size=count))
+
+# The old one-car-at-a-time functions that main-slow.py uses
+def benchmark_components(track:Track, rng:np.random.Generator) -> Dict:
+    positions, angles = sample_cars(track, 200, rng)
+    cars = [Car(None, None, tuple(position), angle, TRAINING_CONFIG["SPAWN_VELOCITY"])
+            for position, angle in zip(positions, angles)]
+    for car in cars:
+        car.move(0, 0)  # Sets the hitbox
+    throttle = rng.integers(0, 2, size=len(cars)).tolist()
+    steering = rng.integers(-1, 2, size=len(cars)).tolist()
+    rays = [Ray(None, None, tuple(position), -angle + i) for position, angle in zip(positions, angles) for i in ray_angles]
+    borders = (track.inner_border_geometry, track.outer_border_geometry)
+
+    def move_cars():
+        for car, car_throttle, car_steering in zip(cars, throttle, steering):
+            car.move(car_throttle, car_steering)
+
+    def cast_rays():
+        for ray in rays:
+            ray.multi_cast(borders)
+
+    def collide_cars():
+        for car in cars:
+            track.collide(car.hitbox, car.passed_checkpoints)
+
+    def find_checkpoints():
+        for car in cars:
+            find_nearest_cp(track, car)
+
+    return {
+        "car_move_steps_per_second": measure(move_cars, len(cars)),
+        "ray_multi_cast_rays_per_second": measure(cast_rays, len(rays)),
+        "track_collide_queries_per_second": measure(collide_cars, len(cars)),
+        "find_nearest_cp_calls_per_second": measure(find_checkpoints, len(cars)),
+    }
+
+# The batched versions of the same things that main.py uses, for a whole population at once
+def benchmark_batches(track:Track, population:int, rng:np.random.Generator) -> Dict:
+    positions, angles = sample_cars(track, population, rng)
+    cars = CarBatch(None, None, population, track.start_point, track.start_angle, TRAINING_CONFIG["SPAWN_VELOCITY"])
+    cars.position[:] = positions
+    cars.facing_angle[:] = angles
+    cars.velocity_angle[:] = -angles
+    throttle = rng.integers(0, 2, size=population).astype(float)
+    steering = rng.integers(-1, 2, size=population).astype(float)
+    ray_directions = ray_angle_array - angles[:, np.newaxis]
+    hitboxes = cars.hitboxes()
+    moved = positions + rng.normal(size=positions.shape)
+    centerline_segments, _ = track.centerline.project(positions)
+
+    return {
+        "car_batch_move_steps_per_second": measure(lambda: cars.move(throttle, steering), population),
+        "batch_cast_rays_per_second": measure(lambda: batch_cast(positions, ray_directions, track.border_segments,
+                                                                 track.raycast_grid), ray_directions.size),
+        "batch_collide_queries_per_second": measure(lambda: track.batch_collide(hitboxes, positions, moved), population),
+        "next_checkpoints_queries_per_second": measure(lambda: track.next_checkpoints(positions, angles, centerline_segments),
+                                                       population),
+    }
+
+# Full training: every generation is a whole Simulation from start to finish
+def benchmark_training(track:Track, population:int, generations:int, seed:int) -> Dict:
+    config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction, neat.DefaultSpeciesSet,
+                         neat.DefaultStagnation, Path("neat_config.txt"))
+    config.pop_size = population
+    random.seed(seed)
+    p = neat.Population(config)
+
+    ticks = 0
+    elapsed = 0
+    def evaluate(genomes, config):
+        nonlocal ticks, elapsed
+        start = time.perf_counter()
+        sim = Simulation(track, genomes, config)
+        sim.run()
+        elapsed += time.perf_counter() - start
+        ticks += sim.ticks
+
+    p.run(evaluate, generations)
+    return {
+        "ticks": ticks,
+        "seconds": elapsed,
+        "ticks_per_second": ticks / elapsed,
+        "generations_per_minute": generations * 60 / elapsed,
+    }
+
+def run(populations:List[int], generations:int, seed:int) -> Dict:
+    with open(Path("data/tracks.json"), 'r') as tracks_raw:
+        tracks = json.load(tracks_raw)
+
+    results = {
+        "seed": seed,
+        "generations": generations,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "tracks": [],
+    }
+    for i, track_data in enumerate(tracks):
+        track = Track(None, (1080, 720), track_data)
+        rng = np.random.default_rng(seed)
+        print(f"Track {i}: components")
+        track_results = {
+            "track": i,
+            "border_segments": len(track.border_segments),
+            "checkpoints": len(track.checkpoints),
+            "components": benchmark_components(track, rng),
+            "populations": {},
+        }
+        for population in populations:
+            print(f"Track {i}: population {population}")
+            track_results["populations"][str(population)] = {
+                **benchmark_batches(track, population, rng),
+                **benchmark_training(track, population, generations, seed),
+            }
+        results["tracks"].append(track_results)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how fast the simulation runs.")
+    parser.add_argument("--populations", type=int, nargs="+", default=[50, 200, 500],
+                        help="Population sizes to test.")
+    parser.add_argument("--generations", type=int, default=3, help="Generations to train for at each population size.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for everything random.")
+    parser.add_argument("--output", type=Path, default=Path("benchmark.json"), help="Where to write the results.")
+    args = parser.parse_args()
+
+    results = run(args.populations, args.generations, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
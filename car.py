@@ -1,22 +1,12 @@
-import pygame as pg
-from typing import Tuple
-from ast import literal_eval
+from typing import Tuple, TYPE_CHECKING
 from math import inf as infinity
-from math import sqrt
-# These get used so often that it's easier if they don't have a prefix
-from pygame.math import clamp
-from pygame import Vector2
-# I know there's an official python library for this (configparser), but configobj has more options and supports things like nested config sections.
-from configobj import ConfigObj
-cfg = ConfigObj("config.txt")["CAR"]
-
-# Pygame has trouble rotating images around their center for some reason.
-def blitRotateCenter(surf, image, topleft, angle):
-
-    rotated_image = pg.transform.rotate(image, angle)
-    new_rect = rotated_image.get_rect(center = image.get_rect(topleft = topleft).center)
-
-    surf.blit(rotated_image, new_rect)
+from math import sqrt, sin, cos, pi, fmod
+import numpy as np
+# Only needed for the type hints, pygame itself is only loaded when something gets drawn (see render.py)
+if TYPE_CHECKING:
+    import pygame as pg
+from settings import load_config
+cfg = load_config().CAR
 
 # Maps a value from one range of values to the equivalent place in another range of values.
 def map_ranges(value, from_min, from_max, to_min, to_max):
@@ -27,45 +17,87 @@ def map_ranges(value, from_min, from_max, to_min, to_max):
 
     return to_min + (scaled * to_span)
 
+# Same as pygame.math.clamp
+def clamp(value, min_value, max_value):
+    if value < min_value:
+        return min_value
+    if value > max_value:
+        return max_value
+    return value
+
+# Just enough of pygame's Vector2 for the car physics, so cars can be used without pygame.
+class Vector2:
+    def __init__(self, x:float, y:float) -> None:
+        self.x = x
+        self.y = y
+
+    def __add__(self, other:"Vector2") -> "Vector2":
+        return Vector2(self.x + other.x, self.y + other.y)
+
+    def __iter__(self):
+        return iter((self.x, self.y))
+
+    # Rotates the vector counterclockwise by an angle in degrees, in exactly the same way as
+    # pygame's Vector2.rotate_ip (which works in radians and snaps multiples of 90 degrees so they
+    # come out exact). Doing it any other way gives slightly different rounding.
+    def rotate_ip(self, angle:float) -> None:
+        epsilon = 1e-6
+        angle = fmod(angle * pi / 180, 2 * pi)
+        if angle < 0:
+            angle += 2 * pi
+        if fmod(angle + epsilon, pi / 2) < 2 * epsilon:
+            quarter_turns = int((angle + epsilon) / (pi / 2)) % 4
+            if quarter_turns == 1:
+                self.x, self.y = -self.y, self.x
+            elif quarter_turns == 2:
+                self.x, self.y = -self.x, -self.y
+            elif quarter_turns == 3:
+                self.x, self.y = self.y, -self.x
+        else:
+            angle_cos = cos(angle)
+            angle_sin = sin(angle)
+            self.x, self.y = angle_cos * self.x - angle_sin * self.y, angle_sin * self.x + angle_cos * self.y
+
 class Car:
     # The values for constants can be found (and messed with) in the config.txt file
     # Control constants
-    (MAX_SPEED,
-     TURN_SPEED_MULT,
-     SPEED_START_DELTA,
-     SPEED_END_DELTA,
-     ACCELERATION,
-     BRAKING_FORCE,
-     FRICTION) = [literal_eval(value) for _, value in cfg["CONTROL"].items()]
+    MAX_SPEED = cfg.CONTROL.MAX_SPEED
+    TURN_SPEED_MULT = cfg.CONTROL.TURN_SPEED_MULT
+    SPEED_START_DELTA = cfg.CONTROL.SPEED_START_DELTA
+    SPEED_END_DELTA = cfg.CONTROL.SPEED_END_DELTA
+    ACCELERATION = cfg.CONTROL.ACCELERATION
+    BRAKING_FORCE = cfg.CONTROL.BRAKING_FORCE
+    FRICTION = cfg.CONTROL.FRICTION
 
     # Steering constants
-    (STEERING_RESPONSE,
-     TURN_STEERING_MULT,
-     STEER_START_DELTA,
-     STEER_END_DELTA) = [literal_eval(value) for _, value in cfg["STEERING"].items()]
+    STEERING_RESPONSE = cfg.STEERING.STEERING_RESPONSE
+    TURN_STEERING_MULT = cfg.STEERING.TURN_STEERING_MULT
+    STEER_START_DELTA = cfg.STEERING.STEERING_START_DELTA
+    STEER_END_DELTA = cfg.STEERING.STEERING_END_DELTA
 
     # Grip constants, determine how "drifty" the car is
-    (SNAP_THRESHOLD,
-     MAX_DELTA,
-     NO_OVERSHOOT,
-     MIN_GRIP,
-     MAX_GRIP,
-     POINT_SCALAR,
-     GRIP_EXP) = [literal_eval(value) for _, value in cfg["PHYSICS"].items()]
+    SNAP_THRESHOLD = cfg.PHYSICS.SNAP_THRESHOLD
+    MAX_DELTA = cfg.PHYSICS.MAX_DELTA
+    NO_OVERSHOOT = cfg.PHYSICS.NO_OVERSHOOT
+    MIN_GRIP = cfg.PHYSICS.MIN_GRIP
+    MAX_GRIP = cfg.PHYSICS.MAX_GRIP
+    POINT_SCALAR = cfg.PHYSICS.POINT_SCALAR
+    GRIP_EXP = cfg.PHYSICS.GRIP_EXP
     if MAX_GRIP < 0 or MAX_GRIP < MIN_GRIP:
         MAX_GRIP = infinity
 
     # Display constants
-    (WIDTH,
-     LENGTH,
-     BODY_COLOR) = [literal_eval(value) for _, value in cfg["DISPLAY"].items()]
+    WIDTH = cfg.DISPLAY.WIDTH
+    LENGTH = cfg.DISPLAY.LENGTH
+    BODY_COLOR = cfg.DISPLAY.BODY_COLOR
+    SPRITE_ANGLES = cfg.DISPLAY.SPRITE_ANGLES
 
     # Debug constants
-    (VECTOR_DEBUG,
-     VELOCITY_COLOR,
-     FACING_COLOR,
-     LINE_WIDTH,
-     DEBUG_TEXT) = [literal_eval(value) for _, value in cfg["DEBUG"].items()]
+    VECTOR_DEBUG = cfg.DEBUG.VECTOR_DEBUG
+    VELOCITY_COLOR = cfg.DEBUG.VELOCITY_COLOR
+    FACING_COLOR = cfg.DEBUG.FACING_COLOR
+    LINE_WIDTH = cfg.DEBUG.LINE_WIDTH
+    DEBUG_TEXT = cfg.DEBUG.DEBUG_TEXT
 
     # Used for checkpoint passes and collisions with track border.
     hitbox = ((0, 0,), (WIDTH, 0), (WIDTH, LENGTH), (0, LENGTH))
@@ -76,7 +108,7 @@ class Car:
     # checkpoints from being counted more than once per lap.
     passed_checkpoints = []
 
-    def __init__(self, surface:pg.surface.Surface, debug_font:pg.font.SysFont, start_position:Tuple[float,float],
+    def __init__(self, surface:"pg.surface.Surface", debug_font:"pg.font.Font", start_position:Tuple[float,float],
                 start_angle:float, initial_velocity:float=0,) -> None:
         self.surface = surface
         self.debug_font = debug_font
@@ -175,35 +207,99 @@ class Car:
 
 
     def display(self) -> None:
-        sub_surface = pg.Surface((self.WIDTH, self.LENGTH), pg.SRCALPHA)
-        pg.draw.rect(sub_surface, self.BODY_COLOR,
-                    pg.rect.Rect(0, 0, self.WIDTH, self.LENGTH))
-        sub_rect = sub_surface.get_rect()
-        sub_rect.center = (self.position.x, self.position.y)
-
-        blitRotateCenter(self.surface, sub_surface, sub_rect.topleft, self.facing_angle)
-
-        if self.VECTOR_DEBUG:
-            v_scaled = Vector2(0, self.speed * 50)
-            v_scaled.rotate_ip(self.velocity_angle)
-            v_end = (self.position + v_scaled)
-            pg.draw.line(self.surface, self.VELOCITY_COLOR,
-                         (self.position.x, self.position.y),
-                         (v_end.x, v_end.y), self.LINE_WIDTH)
-
-            f_scaled = Vector2(0, self.speed * 50)
-            f_scaled.rotate_ip(-self.facing_angle)
-            f_end = (self.position + f_scaled)
-            pg.draw.line(self.surface, self.FACING_COLOR,
-                         (self.position.x, self.position.y),
-                         (f_end.x, f_end.y), self.LINE_WIDTH)
-
-        if self.DEBUG_TEXT:
-            # pygame fonts can only render one line at a time
-            lines = [
-                f"Current Speed: {self.speed}",
-                f"Angle Delta: {self.angle_delta}"
-            ]
-            for i, line in enumerate(lines):
-                img = self.debug_font.render(line, True, (255, 255, 255))
-                self.surface.blit(img, (10, i*20)) 
\ No newline at end of file
+        from render import draw_car
+        draw_car(self.surface, self.debug_font, self.position, self.facing_angle,
+                 self.velocity_angle, self.speed, self.angle_delta)
+
+
+# Stores a whole population of cars as arrays (one entry per car) instead of one object per car,
+# so that every car can be moved with a single call. Uses the exact same physics as Car.move.
+# Cars are never removed from the arrays; dead cars are just marked as not alive and stop moving.
+class CarBatch:
+    def __init__(self, surface:"pg.surface.Surface", debug_font:"pg.font.Font", count:int,
+                start_position:Tuple[float,float], start_angle:float, initial_velocity:float=0) -> None:
+        self.surface = surface
+        self.debug_font = debug_font
+        self.count = count
+
+        self.position = np.tile(np.array(start_position, dtype=float), (count, 1))
+        self.speed = np.full(count, float(initial_velocity))
+        # Same as Car, the velocity angle is the reverse of the facing angle.
+        self.facing_angle = np.full(count, float(start_angle))
+        self.velocity_angle = np.full(count, -float(start_angle))
+        self.angle_delta = np.zeros(count)
+        self.distance_since_last = np.full(count, float(Car.distance_since_last))
+        self.alive = np.ones(count, dtype=bool)
+
+    # Same as Car.move, but throttle and steering input are arrays with one value per car.
+    def move(self, throttle:np.ndarray, steering_input:np.ndarray) -> None:
+        accel = np.where(throttle > 0, Car.ACCELERATION,
+                         np.where(throttle < 0, -Car.BRAKING_FORCE, -Car.FRICTION))
+
+        abs_delta = np.abs(self.angle_delta)
+        speed = self.speed + accel
+        speed_reduction = batch_map_ranges(abs_delta, Car.SPEED_START_DELTA, Car.SPEED_END_DELTA,
+                                           1, Car.TURN_SPEED_MULT)
+        speed_reduction = np.clip(speed_reduction, min(Car.TURN_SPEED_MULT, 1), max(Car.TURN_SPEED_MULT, 1))
+        speed = np.clip(speed, 0, Car.MAX_SPEED * speed_reduction)
+
+        # Calculate steering reduction based on facing angle, then update facing angle
+        steering_amount = Car.STEERING_RESPONSE * steering_input
+        steering_reduction = batch_map_ranges(abs_delta, Car.STEER_START_DELTA, Car.STEER_END_DELTA,
+                                              1, Car.TURN_STEERING_MULT)
+        steering_reduction = np.clip(steering_reduction, min(Car.TURN_STEERING_MULT, 1),
+                                     max(Car.TURN_STEERING_MULT, 1))
+        facing_angle = self.facing_angle - steering_amount * steering_reduction
+
+        # Do all the drift physics calculations
+        angle_delta = -facing_angle - self.velocity_angle
+        velocity_angle = self.__turn_velocity(facing_angle, angle_delta)
+
+        # Same rotation as Vector2(0, speed).rotate_ip(velocity_angle)
+        velocity_radians = np.radians(velocity_angle)
+        position = self.position + np.column_stack((-speed * np.sin(velocity_radians),
+                                                    speed * np.cos(velocity_radians)))
+        moved = position - self.position
+        distance_since_last = np.sqrt(moved[:, 0]**2 + moved[:, 1]**2)
+
+        # Only the cars that are still alive actually get updated
+        alive = self.alive
+        self.speed = np.where(alive, speed, self.speed)
+        self.facing_angle = np.where(alive, facing_angle, self.facing_angle)
+        self.angle_delta = np.where(alive, angle_delta, self.angle_delta)
+        self.velocity_angle = np.where(alive, velocity_angle, self.velocity_angle)
+        self.position = np.where(alive[:, np.newaxis], position, self.position)
+        self.distance_since_last = np.where(alive, distance_since_last, self.distance_since_last)
+
+    # Same as Car.__turn_velocity, but returns the new velocity angles instead of setting them.
+    def __turn_velocity(self, facing_angle:np.ndarray, angle_delta:np.ndarray) -> np.ndarray:
+        abs_delta = np.abs(angle_delta)
+        turn_amount = np.clip(Car.GRIP_EXP ** (0.1 * (abs_delta - Car.POINT_SCALAR)), Car.MIN_GRIP, Car.MAX_GRIP)
+        turn_amount = np.where(angle_delta < 0, -turn_amount, turn_amount)
+
+        velocity_angle = np.clip(self.velocity_angle + turn_amount,
+                                 -facing_angle - Car.MAX_DELTA, -facing_angle + Car.MAX_DELTA)
+
+        if Car.NO_OVERSHOOT:
+            new_delta = -(facing_angle + velocity_angle)
+            overshoot = ((angle_delta < 0) & (new_delta > 0)) | ((angle_delta > 0) & (new_delta < 0))
+            velocity_angle = np.where(overshoot, -facing_angle, velocity_angle)
+
+        return np.where(abs_delta < Car.SNAP_THRESHOLD, -facing_angle, velocity_angle)
+
+    # Returns every car's hitbox as an (N, 4, 2) array, with the corners in the same order as Car.hitbox.
+    def hitboxes(self) -> np.ndarray:
+        half_size = np.array((Car.WIDTH / 2, Car.LENGTH / 2))
+        corners = np.array(((-1, -1), (1, -1), (1, 1), (-1, 1))) * half_size
+        return self.position[:, np.newaxis, :] + corners
+
+    # Draws the given cars, or every car that's still alive if none are given
+    def display(self, cars:np.ndarray=None) -> None:
+        from render import draw_cars
+        draw_cars(self.surface, self.debug_font, self, cars)
+
+
+# Same as map_ranges, but works on whole arrays at once.
+def batch_map_ranges(values:np.ndarray, from_min:float, from_max:float, to_min:float, to_max:float) -> np.ndarray:
+    scaled = (values - from_min) / (from_max - from_min)
+    return to_min + (scaled * (to_max - to_min))
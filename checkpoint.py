@@ -0,0 +1,134 @@
+# Saves snapshots of a training run so it can be picked back up if it gets interrupted. A snapshot
+# has everything needed to carry on exactly as if the run never stopped: the population, species,
+# NEAT's internal counters, the best genome so far, the random number generator's state, plus
+# whatever else main.py hands it (the reporters and which track it's on).
+#
+# Taking a snapshot only has to copy everything into memory (with pickle), which is quick.
+# Compressing it and writing it to disk happens on a separate thread while the next generation
+# runs. Snapshots get written to a temporary file first and then renamed, so a run that gets
+# killed halfway through saving one never leaves a broken snapshot behind.
+
+import gzip
+import io
+import os
+import pickle
+import random
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional
+import neat
+
+# Changing what goes into a snapshot means older snapshots can't be resumed anymore
+VERSION = 2
+
+# The population, species set and reproduction all share the population's ReporterSet (which
+# has this checkpointer in it, among other things). Instead of saving it, snapshots just mark
+# where it goes, and it gets swapped for the resumed population's own ReporterSet.
+class SnapshotPickler(pickle.Pickler):
+    def __init__(self, file, reporters:neat.reporting.ReporterSet) -> None:
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.reporters = reporters
+
+    def persistent_id(self, obj) -> Optional[str]:
+        return "reporters" if obj is self.reporters else None
+
+class SnapshotUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid:str) -> neat.reporting.ReporterSet:
+        if pid != "reporters":
+            raise pickle.UnpicklingError(f"Unknown reference in snapshot: {pid}")
+        # Gets replaced by restore_population
+        return neat.reporting.ReporterSet()
+
+
+class TrainingCheckpointer(neat.reporting.BaseReporter):
+    # Saves a snapshot of the population every "every" generations. get_state returns anything
+    # else that needs to be saved, as a dictionary.
+    def __init__(self, population:neat.Population, every:int, directory:Path, keep:int,
+                get_state:Callable[[], Dict]=dict) -> None:
+        self.population = population
+        self.every = every
+        self.directory = Path(directory)
+        self.keep = keep
+        self.get_state = get_state
+        self.generation = None
+        self.writer = None
+
+    def start_generation(self, generation:int) -> None:
+        self.generation = generation
+
+    def end_generation(self, config, population, species_set) -> None:
+        if self.every > 0 and (self.generation + 1) % self.every == 0:
+            self.save()
+
+    # Takes a snapshot right now, and starts writing it in the background
+    def save(self) -> None:
+        p = self.population
+        snapshot = {
+            "version": VERSION,
+            "generation": self.generation,
+            "config": p.config,
+            "population": p.population,
+            "species": p.species,
+            "genome_indexer": p.reproduction.genome_indexer,
+            "ancestors": p.reproduction.ancestors,
+            "best_genome": p.best_genome,
+            "random_state": random.getstate(),
+            "state": self.get_state(),
+        }
+        data = io.BytesIO()
+        SnapshotPickler(data, p.reporters).dump(snapshot)
+
+        # Only one snapshot gets written at a time
+        self.wait()
+        path = self.directory / f"checkpoint-{self.generation:05d}.pickle.gz"
+        self.writer = threading.Thread(target=self.__write, args=(data.getvalue(), path))
+        self.writer.start()
+
+    # Waits for the last snapshot to finish being written
+    def wait(self) -> None:
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+    def __write(self, data:bytes, path:Path) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = path.with_name(path.name + ".tmp")
+            with open(temp_path, "wb") as f:
+                f.write(gzip.compress(data, compresslevel=6))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+
+            # Delete the oldest snapshots (or keep all of them if keep is 0)
+            if self.keep > 0:
+                for old in sorted(self.directory.glob("checkpoint-*.pickle.gz"))[:-self.keep]:
+                    old.unlink()
+        except OSError as e:
+            # Losing a snapshot isn't worth crashing the whole training run over
+            print(f"Couldn't save checkpoint {path}: {e}")
+
+
+# Returns the newest snapshot in a folder, or None if there aren't any
+def latest_checkpoint(directory:Path) -> Optional[Path]:
+    snapshots = sorted(Path(directory).glob("checkpoint-*.pickle.gz"))
+    return snapshots[-1] if snapshots else None
+
+def load_checkpoint(path:Path) -> Dict:
+    with gzip.open(path, "rb") as f:
+        snapshot = SnapshotUnpickler(f).load()
+    if snapshot.get("version") != VERSION:
+        raise ValueError(f"{path} was saved by a different version and can't be resumed")
+    return snapshot
+
+# Rebuilds the population from a snapshot, ready to carry on from the generation after the one
+# it was saved at. This also puts the random number generator back where it was.
+def restore_population(snapshot:Dict) -> neat.Population:
+    p = neat.Population(snapshot["config"], (snapshot["population"], snapshot["species"],
+                                             snapshot["generation"] + 1))
+    p.species.reporters = p.reporters
+    p.reproduction.genome_indexer = snapshot["genome_indexer"]
+    p.reproduction.ancestors = snapshot["ancestors"]
+    p.best_genome = snapshot["best_genome"]
+    random.setstate(snapshot["random_state"])
+    return p
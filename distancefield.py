@@ -0,0 +1,163 @@
+# A signed distance field for a track: a grid of points covering the whole track, where each point
+# stores how far it is from the nearest wall (positive inside the track, negative outside of it).
+# Looking up a distance only has to read the 4 grid points around a position, no matter how
+# complicated the track is, so it's a lot faster than doing the exact geometry every update.
+#
+# The catch is that it's approximate. Distances in between the grid points are interpolated, and
+# since the distance to a wall can't change faster than the position does, the interpolated value
+# is never off by more than resolution / sqrt(2) compared to the exact Shapely distance (this is
+# what error_bound is). Fields are built once per track and resolution, then cached to disk.
+
+import os
+from hashlib import sha1
+from math import sqrt
+from pathlib import Path
+from typing import Tuple
+import numpy as np
+import shapely
+from shapely import LinearRing, Polygon
+
+class DistanceField:
+    # Bump this if the way fields are built changes, so old cached fields don't get used
+    VERSION = 1
+
+    def __init__(self, inner_border:LinearRing, outer_border:LinearRing, resolution:float,
+                max_steps:int, cache_dir:str=None) -> None:
+        self.resolution = resolution
+        self.error_bound = resolution / sqrt(2)
+        self.max_steps = max_steps
+
+        # The grid goes a bit past the outer border, so everything outside of it is outside the track
+        min_x, min_y, max_x, max_y = outer_border.bounds
+        margin = 2 * resolution
+        self.min_corner = np.array((min_x - margin, min_y - margin))
+        self.shape = np.ceil((np.array((max_x, max_y)) + margin - self.min_corner) / resolution).astype(int) + 1
+
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = Path(cache_dir) / f"{self.__cache_key(inner_border, outer_border)}.npz"
+        if cache_file is not None and cache_file.exists():
+            with np.load(cache_file) as cached:
+                self.distances = cached["distances"]
+                self.nearest_inner = cached["nearest_inner"]
+        else:
+            self.distances, self.nearest_inner = self.__build(inner_border, outer_border)
+            if cache_file is not None:
+                self.__save(cache_file)
+
+    # Every field with the same borders, resolution and version is the same, so this is all that
+    # goes into the cache file name.
+    def __cache_key(self, inner_border:LinearRing, outer_border:LinearRing) -> str:
+        key = sha1()
+        key.update(np.asarray(inner_border.coords, dtype=float).tobytes())
+        key.update(np.asarray(outer_border.coords, dtype=float).tobytes())
+        key.update(np.array((self.resolution, self.VERSION), dtype=float).tobytes())
+        return key.hexdigest()
+
+    # Calculates the exact distance at every grid point, and whether the inner or outer border is closer
+    def __build(self, inner_border:LinearRing, outer_border:LinearRing) -> Tuple[np.ndarray, np.ndarray]:
+        xs = self.min_corner[0] + np.arange(self.shape[0]) * self.resolution
+        ys = self.min_corner[1] + np.arange(self.shape[1]) * self.resolution
+        grid_x, grid_y = np.meshgrid(xs, ys)
+        points = shapely.points(grid_x, grid_y)
+
+        inner_distance = shapely.distance(inner_border, points)
+        outer_distance = shapely.distance(outer_border, points)
+        track = Polygon(outer_border, [inner_border])
+        sign = np.where(shapely.contains_xy(track, grid_x, grid_y), 1.0, -1.0)
+        return (sign * np.minimum(inner_distance, outer_distance), inner_distance < outer_distance)
+
+    # Writes to a temporary file first, so a half-written field never ends up in the cache
+    def __save(self, cache_file:Path) -> None:
+        os.makedirs(cache_file.parent, exist_ok=True)
+        temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_file, "wb") as f:
+            np.savez(f, distances=self.distances, nearest_inner=self.nearest_inner)
+        os.replace(temp_file, cache_file)
+
+    # Returns the grid cell each (N, 2) point is in, and how far across that cell it is (0 to 1).
+    # Points outside the grid get clamped to its edge, which is always outside the track.
+    def __locate(self, points:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        position = np.clip((points - self.min_corner) / self.resolution, 0, self.shape - 1)
+        cells = np.minimum(np.floor(position).astype(int), self.shape - 2)
+        return (cells, position - cells)
+
+    # Returns the signed distance from each (N, 2) point to the nearest wall: positive if the point
+    # is inside the track, and negative if it isn't.
+    def distance(self, points:np.ndarray) -> np.ndarray:
+        cells, along = self.__locate(points)
+        x, y = cells[:, 0], cells[:, 1]
+        along_x, along_y = along[:, 0], along[:, 1]
+        top = self.distances[y, x] * (1 - along_x) + self.distances[y, x + 1] * along_x
+        bottom = self.distances[y + 1, x] * (1 - along_x) + self.distances[y + 1, x + 1] * along_x
+        return top * (1 - along_y) + bottom * along_y
+
+    # Returns whether the inner border is the closest one to each (N, 2) point
+    def inner_is_nearest(self, points:np.ndarray) -> np.ndarray:
+        cells, along = self.__locate(points)
+        cells = cells + np.round(along).astype(int)
+        return self.nearest_inner[cells[:, 1], cells[:, 0]]
+
+    # Returns which (N, V, 2) polygons (like car hitboxes) touch a wall, and whether the inner border
+    # is the one they're closest to. Points are checked along the edges of each polygon, no further
+    # apart than the field's resolution, and a polygon counts as touching a wall if any of them are
+    # outside the track (give or take error_bound).
+    def polygon_hits(self, polygons:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        hit = np.zeros(len(polygons), dtype=bool)
+        inner = np.zeros(len(polygons), dtype=bool)
+
+        # Polygons whose center is further from every wall than their furthest corner can't be
+        # touching one, which is most of them, so only the rest get checked properly.
+        centers = polygons.mean(axis=1)
+        radius = np.sqrt(((polygons - centers[:, np.newaxis, :])**2).sum(axis=2)).max(axis=1)
+        near = np.flatnonzero(self.distance(centers) <= radius + self.error_bound)
+        if len(near) == 0:
+            return (hit, inner)
+
+        polygons = polygons[near]
+        edges = np.roll(polygons, -1, axis=1) - polygons
+        longest = np.sqrt((edges**2).sum(axis=2)).max()
+        count = max(int(np.ceil(longest / self.resolution)), 1)
+        steps = np.arange(count) / count
+        points = (polygons[:, :, np.newaxis, :] + edges[:, :, np.newaxis, :] * steps[:, np.newaxis]).reshape(len(near), -1, 2)
+
+        distances = self.distance(points.reshape(-1, 2)).reshape(len(near), -1)
+        closest = points[np.arange(len(near)), np.argmin(distances, axis=1)]
+        hit[near] = (distances <= 0).any(axis=1)
+        inner[near] = self.inner_is_nearest(closest)
+        return (hit, inner)
+
+    # Same as SegmentGrid.cast, so it can be used by batch_cast in the same way. Rays are sphere
+    # traced: each step moves a ray forward by the distance to the nearest wall (minus error_bound,
+    # so it can't jump over one), but always by at least half the field's resolution. Once a ray
+    # ends up outside the track, the hit is where the distance crossed 0 between its last two steps.
+    # That point is always within error_bound of a wall, but rays at a shallow angle to a wall can
+    # be off by more than that along the ray, and rays can cut across the very tip of a sharp
+    # corner. Rays that haven't hit anything after max_steps report wherever they got to.
+    def cast(self, origins:np.ndarray, directions:np.ndarray, max_distance:float) -> np.ndarray:
+        travelled = np.zeros(len(origins))
+        last_travelled = np.zeros(len(origins))
+        last_distance = np.zeros(len(origins))
+        closest = np.full(len(origins), np.inf)
+        active = np.ones(len(origins), dtype=bool)
+        min_step = self.resolution / 2
+
+        for _ in range(self.max_steps):
+            rays = np.flatnonzero(active)
+            if len(rays) == 0:
+                break
+            wall_distance = self.distance(origins[rays] + directions[rays] * travelled[rays, np.newaxis])
+
+            hit = wall_distance <= 0
+            hit_rays = rays[hit]
+            crossing = last_distance[hit_rays] / np.maximum(last_distance[hit_rays] - wall_distance[hit], 1e-12)
+            closest[hit_rays] = last_travelled[hit_rays] + (travelled[hit_rays] - last_travelled[hit_rays]) * crossing
+
+            last_travelled[rays] = travelled[rays]
+            last_distance[rays] = wall_distance
+            travelled[rays] += np.maximum(wall_distance - self.error_bound, min_step)
+            active[rays[hit | (travelled[rays] >= max_distance)]] = False
+
+        still_going = active & (travelled < max_distance)
+        closest[still_going] = travelled[still_going]
+        return closest
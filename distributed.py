@@ -0,0 +1,174 @@
+# Splits each generation across worker processes on other computers (or the same one), for
+# populations too big for one computer. Training runs a coordinator (turn on DISTRIBUTED in
+# config.txt), and workers connect to it over the network:
+#
+#     python distributed.py 192.168.1.20                 one worker, connecting to the coordinator there
+#     python distributed.py localhost --processes 4      four workers on this computer
+#
+# The coordinator (DistributedEvaluator in parallel.py) splits every generation into shares just
+# like PoolEvaluator does, and hands them out one at a time: a worker only gets another share once
+# it's sent back the last one, so faster computers end up doing more of the work. If a worker
+# disconnects or stops responding for DISTRIBUTED_TIMEOUT seconds, its share goes back in the queue
+# for another worker. The results are put together exactly the same way PoolEvaluator does it, so
+# they're the same as training on one computer. Workers get the coordinator's config when they
+# connect, before any of the simulation code is imported (it reads the config as soon as it's
+# imported), so they only need the same code. Their own config.txt just sets the defaults for
+# --port and --key.
+#
+# Messages are pickled Python objects (see multiprocessing.connection), which means anyone who can
+# connect can make the other side run any code they want. Workers have to know DISTRIBUTED_KEY to
+# connect. The coordinator only listens on this computer (DISTRIBUTED_HOST is 127.0.0.1) unless
+# it's told otherwise, and it won't listen anywhere else until DISTRIBUTED_KEY has been changed.
+
+# Nothing that reads the config when it's imported can be imported up here, since workers only get
+# their config once they've connected (see run_worker)
+import argparse
+import ipaddress
+import multiprocessing as mp
+import os
+import platform
+import socket
+import tempfile
+import threading
+import time
+from hashlib import sha1
+from multiprocessing.connection import Client
+from pathlib import Path
+from typing import Dict
+import numpy as np
+from settings import load_config
+
+# The DISTRIBUTED_KEY config.txt comes with, which everyone who's downloaded this knows
+DEFAULT_KEY = "drift"
+
+# Whether an address can only be reached from this computer
+def is_local(host:str) -> bool:
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+# Everything that has to be the same for a worker to get exactly the same results as the
+# coordinator, besides the config (which workers get from the coordinator): the code, and the
+# NumPy and Python versions (which can change how the math gets done). Workers that don't match
+# get turned away.
+def fingerprint() -> Dict[str, str]:
+    code = sha1()
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        code.update(path.name.encode())
+        code.update(path.read_bytes())
+    return {
+        "code": code.hexdigest(),
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+    }
+
+
+# Recordings get made on the worker and sent back, and are written to a temporary file first just
+# like TrajectoryRecorder does, so a half-written one never looks finished
+def save_recording(recording:bytes, path:Path) -> None:
+    path = Path(path)
+    os.makedirs(path.parent, exist_ok=True)
+    temp_path = path.with_name(path.name + ".tmp")
+    temp_path.write_bytes(recording)
+    os.replace(temp_path, path)
+
+# Saves a compiled track sent by the coordinator to "path", unless this computer already has it.
+# Compiled tracks are named after what's in them, so one with the same name is always the same track.
+def save_track(track:bytes, path:Path) -> Path:
+    if not path.exists():
+        os.makedirs(path.parent, exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temp_path.write_bytes(track)
+        os.replace(temp_path, path)
+    return path
+
+# Connects to a coordinator and runs shares for it until it's done training. Keeps trying to
+# connect until the coordinator is running.
+def run_worker(host:str, port:int, key:str) -> None:
+    waiting = False
+    while True:
+        try:
+            conn = Client((host, port), authkey=key.encode())
+            break
+        except ConnectionRefusedError:
+            if not waiting:
+                print(f"Waiting for the coordinator at {host}:{port}")
+                waiting = True
+            time.sleep(1)
+        except mp.AuthenticationError:
+            print("The coordinator turned this worker away (is DISTRIBUTED_KEY the same on both computers?)")
+            return
+
+    _, coordinator, coordinator_config, max_tracks, heartbeat = conn.recv()
+    mismatched = [name for name, value in fingerprint().items() if coordinator[name] != value]
+    if mismatched:
+        print(f"This worker can't give the same results as the coordinator, because its {', '.join(mismatched)} "
+              f"{'is' if len(mismatched) == 1 else 'are'} different")
+        conn.close()
+        return
+    # The coordinator's config has to be handed in before the simulation code gets imported
+    load_config(config=coordinator_config)
+    import parallel
+    from trackfile import COMPILED_DIR
+    parallel.init_worker(mp.Array("q", [parallel.NO_STALL] * max_tracks), coordinator_config)
+    conn.send(("ready",))
+    print(f"Connected to {host}:{port}")
+
+    # Lets the coordinator know this worker is still going, even while it's busy with a share
+    send_lock = threading.Lock()
+    stopped = threading.Event()
+    def keep_alive() -> None:
+        while not stopped.wait(heartbeat):
+            try:
+                with send_lock:
+                    conn.send(("alive",))
+            except OSError:
+                return
+    threading.Thread(target=keep_alive, daemon=True).start()
+
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == "stop":
+                break
+            _, share, (genomes, config, track_name, slot, resumed, record, stall_tick), track = message
+            track_path = COMPILED_DIR / track_name
+            if track is not None:
+                save_track(track, track_path)
+            parallel.stall_ticks[slot] = stall_tick
+            recording = None
+            if record:
+                record_path = Path(tempfile.gettempdir()) / f"share-{os.getpid()}.rec"
+                result = parallel.evaluate_share(genomes, config, track_path, slot, resumed, record_path)
+                recording = record_path.read_bytes()
+                record_path.unlink()
+            else:
+                result = parallel.evaluate_share(genomes, config, track_path, slot, resumed)
+            with send_lock:
+                conn.send(("share", share, result, recording))
+    except (EOFError, OSError):
+        print("Lost the connection to the coordinator")
+    finally:
+        stopped.set()
+        conn.close()
+
+
+if __name__ == "__main__":
+    TRAINING_CONFIG = load_config().AI_TRAINING
+    parser = argparse.ArgumentParser(description="Runs shares of each generation for a training run on another computer.")
+    parser.add_argument("host", help="Address of the computer running main.py (with DISTRIBUTED on).")
+    parser.add_argument("--port", type=int, default=TRAINING_CONFIG["DISTRIBUTED_PORT"], help="Port the coordinator is listening on.")
+    parser.add_argument("--key", default=TRAINING_CONFIG["DISTRIBUTED_KEY"], help="The coordinator's DISTRIBUTED_KEY.")
+    parser.add_argument("--processes", type=int, default=1, help="How many workers to run on this computer (0 for one per core).")
+    args = parser.parse_args()
+
+    processes = args.processes if args.processes > 0 else os.cpu_count()
+    if processes == 1:
+        run_worker(args.host, args.port, args.key)
+    else:
+        workers = [mp.Process(target=run_worker, args=(args.host, args.port, args.key)) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
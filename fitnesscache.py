@@ -0,0 +1,83 @@
+# Remembers how genomes did on each track, so genomes that survive from one generation to the next
+# unchanged (like the elites) don't have to be simulated again. The simulation always does exactly
+# the same thing for the same network on the same track, so this never changes the results.
+#
+# What makes it a little tricky is that a car's fitness depends on when the generation ends, which
+# is whenever *any* car stops moving. So instead of just a fitness value, the cache keeps each car's
+# fitness after every update it was simulated for, and the generation's results get worked out the
+# same way as when it's split into shares (see parallel.py). Cars that were still alive when their
+# generation ended also have everything about them saved at that point, so if a later generation
+# goes on for longer, they only have to be simulated from there instead of from the start.
+
+from collections import OrderedDict
+from hashlib import sha1
+from pathlib import Path
+from typing import List, Optional, Tuple
+import numpy as np
+from settings import load_config
+
+# What gets cached for each genome on each track: the car's fitness after each update it was
+# simulated for, the update where it stopped moving (or None), its final fitness (or None if it was
+# still alive), and if it was still alive, its state after the last update (see Simulation.car_state)
+Outcome = Tuple[np.ndarray, Optional[int], Optional[float], Optional[Tuple]]
+
+# Genomes with the same nodes and connections (and the same weights, biases, etc.) always make the
+# same network, even if they're different genomes
+def genome_key(genome) -> str:
+    nodes = sorted((key, node.bias, node.response, node.activation, node.aggregation)
+                   for key, node in genome.nodes.items())
+    connections = sorted((key, connection.weight, connection.enabled)
+                         for key, connection in genome.connections.items())
+    return sha1(repr((nodes, connections)).encode()).hexdigest()
+
+
+# Only keeps the "size" most recently used outcomes, so it doesn't keep growing over a long run. Each
+# outcome takes up 8 bytes for every update the car lasted.
+class FitnessCache:
+    def __init__(self, size:int) -> None:
+        self.size = size
+        self.outcomes = OrderedDict()
+        # Everything in config.txt goes into every key, just in case one cache ever gets used with
+        # a different config
+        self.fingerprint = sha1(repr(load_config()).encode()).hexdigest()
+        self.hits = 0
+        self.misses = 0
+
+    # Takes a genome_key. Track paths are compiled track files, which are already named after what's
+    # in them (see trackfile.py).
+    def key(self, genome:str, track_path:Path) -> Tuple[str, str, str]:
+        return (genome, Path(track_path).name, self.fingerprint)
+
+    def get(self, key:Tuple[str, str, str]) -> Optional[Outcome]:
+        outcome = self.outcomes.get(key)
+        if outcome is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.outcomes.move_to_end(key)
+        return outcome
+
+    def put(self, key:Tuple[str, str, str], outcome:Outcome) -> None:
+        self.outcomes[key] = outcome
+        self.outcomes.move_to_end(key)
+        while len(self.outcomes) > self.size:
+            self.outcomes.popitem(last=False)
+
+
+# Works out every car's outcome from the results of running a share of the population (see
+# parallel.evaluate_share). Returns None for cars that never got simulated (because they were
+# resuming from an update the share didn't get to).
+def share_outcomes(history:np.ndarray, stall:Optional[int], final_fitness:np.ndarray, death_ticks:np.ndarray,
+                   states:List[Optional[Tuple]]) -> List[Optional[Outcome]]:
+    outcomes = []
+    for i, (death, state) in enumerate(zip(death_ticks.tolist(), states)):
+        if state is not None:
+            outcomes.append((history[:, i].copy(), None, None, state))
+        elif death < 0:
+            outcomes.append(None)
+        elif death == stall:
+            outcomes.append((history[:stall + 1, i].copy(), stall, float(final_fitness[i]), None))
+        else:
+            # Crashed during update "death", so its fitness stopped changing after that one
+            outcomes.append((history[:death + 2, i].copy(), None, float(history[death + 1, i]), None))
+    return outcomes
@@ -8,20 +8,11 @@ from utils import *
 from random import choice
 import neat
 
-# I know there's an official python library for this (configparser), but configobj has more options and supports things like nested config sections.
-from configobj import ConfigObj
-from ast import literal_eval
-g_cfg = ConfigObj("config.txt")["GAME"]
-GAME_CONFIG = {}
-for key, value in g_cfg.items():
-    GAME_CONFIG.update({key : literal_eval(value)})
+from settings import load_config
+GAME_CONFIG = load_config().GAME
+TRAINING_CONFIG = load_config().AI_TRAINING
 
-t_cfg = ConfigObj("config.txt")["AI_TRAINING"]
-TRAINING_CONFIG = {}
-for key, value in t_cfg.items():
-    TRAINING_CONFIG.update({key : literal_eval(value)})
-
-TRAINING_CONFIG["TIME_MULTIPLIER_DECAY"] = TRAINING_CONFIG["TIME_MULTIPLIER_DECAY"] / 1000
+TIME_MULTIPLIER_DECAY = TRAINING_CONFIG["TIME_MULTIPLIER_DECAY"] / 1000
 
 # Load tracks
 with open(Path("data/tracks.json"), 'r') as tracks_raw:
@@ -158,7 +149,7 @@ def main(genomes, config) -> None:
 
                     else:
                         # Decrease the car's time multiplier to a minimum of 1
-                        car_multipliers[i] -= TRAINING_CONFIG["TIME_MULTIPLIER_DECAY"]
+                        car_multipliers[i] -= TIME_MULTIPLIER_DECAY
                         if car_multipliers[i] < 1:
                             car_multipliers[i] = 1
 
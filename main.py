@@ -1,198 +1,223 @@
-import pygame as pg
-import json
+import argparse
+from typing import Dict
 from pathlib import Path
 from car import *
 from track import *
 from raycast import *
 from utils import *
-from random import choice
+from simulation import *
+from parallel import DistributedEvaluator, PoolEvaluator
+from trackfile import TrackStore, load_track
+from checkpoint import TrainingCheckpointer, latest_checkpoint, load_checkpoint, restore_population
+from profiler import PhaseProfiler, ProfileReporter
+from recording import RecordingReporter, TrajectoryRecorder
 import neat
-
-# I know there's an official python library for this (configparser), but configobj has more options and supports things like nested config sections.
-from configobj import ConfigObj
-from ast import literal_eval
-g_cfg = ConfigObj("config.txt")["GAME"]
-GAME_CONFIG = {}
-for key, value in g_cfg.items():
-    GAME_CONFIG.update({key : literal_eval(value)})
-
-t_cfg = ConfigObj("config.txt")["AI_TRAINING"]
-TRAINING_CONFIG = {}
-for key, value in t_cfg.items():
-    TRAINING_CONFIG.update({key : literal_eval(value)})
-
-TRAINING_CONFIG["TIME_MULTIPLIER_DECAY"] = TRAINING_CONFIG["TIME_MULTIPLIER_DECAY"] / 50
-
-# Load tracks
-with open(Path("data/tracks.json"), 'r') as tracks_raw:
-    tracks = json.load(tracks_raw)
-
-# Load fonts, can take several seconds to complete
-pg.init()
-default_font = pg.font.SysFont("monospace", 15)
-ray_distance_font = pg.font.SysFont("monospace", 15)
-
-# Create game display and game clock
-window = pg.display.set_mode((1080, 720))
-pg.display.init()
-pg.display.update()
-UPDATE_GAME = pg.USEREVENT
-update_timer = pg.time.set_timer(UPDATE_GAME, 20)
-
-ray_angles = (-90, -45, 0, 45, 90)
-
+import numpy as np
+
+from settings import ConfigError, load_config
+GAME_CONFIG = load_config().GAME
+
+# Everything below gets set up by setup() instead of when this file is imported, so importing it
+# (which every worker process does) doesn't load pygame, open a window, or read the tracks.
+# Every track that can be trained on. Tracks only get read (and compiled) once they're used.
+track_store = None
+# The tracks MULTI_TRACK tests every AI on
+evaluation_tracks = []
+window = None
+default_font = None
+ray_distance_font = None
+UPDATE_GAME = None
+
+def setup() -> None:
+    global track_store, evaluation_tracks, window, default_font, ray_distance_font, UPDATE_GAME, pg
+
+    # Index the tracks (see trackfile.py)
+    track_store = TrackStore()
+    if TRAINING_CONFIG["TRACK_TAG"] is not None and len(track_store.ids(TRAINING_CONFIG["TRACK_TAG"])) == 0:
+        raise ConfigError(f"TRACK_TAG is {TRAINING_CONFIG['TRACK_TAG']!r}, but no tracks in {track_store.tracks_file} have that tag")
+    if TRAINING_CONFIG["EVALUATION_TRACKS"] is None:
+        evaluation_ids = track_store.ids(TRAINING_CONFIG["TRACK_TAG"])
+    else:
+        for i in TRAINING_CONFIG["EVALUATION_TRACKS"]:
+            if i >= len(track_store):
+                raise ConfigError(f"EVALUATION_TRACKS has track {i}, but there are only {len(track_store)} tracks")
+        evaluation_ids = TRAINING_CONFIG["EVALUATION_TRACKS"]
+    # Only MULTI_TRACK uses them, so otherwise they don't need to be compiled
+    if TRAINING_CONFIG["MULTI_TRACK"]:
+        evaluation_tracks = [track_store.path(i) for i in evaluation_ids]
+
+    # Nothing gets drawn in headless mode, so there's no need for a window, fonts, or a timer.
+    if not GAME_CONFIG["HEADLESS"]:
+        import pygame as pg
+        from render import init_display
+        window, default_font, ray_distance_font = init_display((1080, 720))
+
+        # Create game clock
+        UPDATE_GAME = pg.USEREVENT
+        pg.time.set_timer(UPDATE_GAME, 1000 // TICKS_PER_SECOND)
+
+
+# The id (in track_store) of the track being trained on when CHANGE_TRACKS is on, and how many more
+# generations until it changes. Both get saved in checkpoints, so a resumed run stays on the same track.
+current_track = None
+generations_since_change = 0
 
 def main(genomes, config) -> None:
     global current_track
     global generations_since_change
-    if TRAINING_CONFIG["CHANGE_TRACKS"]:
+    if TRAINING_CONFIG["MULTI_TRACK"]:
+        track_paths = evaluation_tracks
+    elif TRAINING_CONFIG["CHANGE_TRACKS"]:
         generations_since_change -= 1
-        if generations_since_change == 0:
-            current_track = choice(tracks)
+        # Tracks only ever get added to the end of the file, so a saved id is still the same track
+        # as long as it's still in there
+        if generations_since_change <= 0 or current_track is None or current_track >= len(track_store):
+            current_track = track_store.sample(TRAINING_CONFIG["TRACK_TAG"])
             generations_since_change = TRAINING_CONFIG["GENERATIONS_PER_TRACK"]
-
-    nets = []
-    ge = []
-    track = Track(window, (1080, 720), choice(tracks))
-    cars = []
-    car_rays = []
-    car_multipliers = []
-
-    for _, g in genomes:
-        net = neat.nn.FeedForwardNetwork.create(g, config)
-        nets.append(net)
-        car = Car(window, default_font, track.start_point,
-                track.start_angle, TRAINING_CONFIG["SPAWN_VELOCITY"])
-        cars.append(car)
-        car_rays.append([Ray(window, ray_distance_font, (car.position.x, car.position.y),
-                    -car.facing_angle + i) for i in ray_angles])
-        car_multipliers.append(TRAINING_CONFIG["MAX_TIME_MULTIPLIER"])
-        g.fitness = 0
-        ge.append(g)
-
-    running = True
-    while running:
-        for event in pg.event.get():
+        track_paths = [track_store.path(current_track)]
+    else:
+        track_paths = [track_store.path(track_store.sample(TRAINING_CONFIG["TRACK_TAG"]))]
+    record_dir = recordings.generation_dir if recordings is not None else None
+    if evaluator is not None:
+        evaluator.evaluate(genomes, config, track_paths, profiler, TRAINING_CONFIG["TRACK_FITNESS"], record_dir)
+        return
+
+    # Without workers, every track just gets run one after another
+    fitness = []
+    for slot, track_path in enumerate(track_paths):
+        track = load_track(track_path, window, (1080, 720))
+        recorder = None
+        if record_dir is not None:
+            recorder = TrajectoryRecorder(record_dir / f"track{slot}.rec", genomes, track_path, ray_angles)
+        sim = Simulation(track, genomes, config, window, default_font, ray_distance_font,
+                        GAME_CONFIG["SHOW_RAYS"] and not GAME_CONFIG["HEADLESS"], profiler, recorder)
+        if GAME_CONFIG["HEADLESS"]:
+            sim.run()
+        else:
+            watch(sim, track)
+        if recorder is not None:
+            recorder.close(sim.death_ticks, sim.fitness)
+        fitness.append(sim.fitness)
+
+    if len(track_paths) > 1:
+        for (_, g), value in zip(genomes, combine_fitness(np.array(fitness), TRAINING_CONFIG["TRACK_FITNESS"]).tolist()):
+            g.fitness = value
+
+# Runs a generation in the window, drawing it as it goes
+def watch(sim:Simulation, track:Track) -> None:
+    while sim.running:
+        # Waits for something to happen instead of redrawing the same thing over and over
+        updated = False
+        for event in [pg.event.wait()] + pg.event.get():
             if event.type == pg.QUIT:
-                running = False
                 pg.quit()
                 quit()
-            elif event.type == UPDATE_GAME:
-
-                for i, car in enumerate(cars):
-                    # Kill the AI if its car hasn't moved far enough since the last update
-                    if car.distance_since_last < TRAINING_CONFIG["MIN_MOVE_AMOUNT"]:
-                        ge[i].fitness -= TRAINING_CONFIG["DEATH_PENALTY"]
-                        cars.pop(i)
-                        car_rays.pop(i)
-                        car_multipliers.pop(i)
-                        nets.pop(i)
-                        ge.pop(i)
-                        running = False
+            # Ignore any leftover updates once the generation is over, otherwise
+            # the results would depend on how fast the display is refreshing.
+            elif event.type == UPDATE_GAME and sim.running:
+                # Runs several updates at once if RENDER_EVERY is more than 1, which speeds up
+                # training without changing the results.
+                for _ in range(GAME_CONFIG["RENDER_EVERY"]):
+                    if not sim.tick():
                         break
+                updated = True
 
-                    # Calculate distances from raycasts
-                    input = []
-                    for ii, ray in enumerate(car_rays[i]):
-                        ray.set_origin((car.position.x, car.position.y))
-                        ray.set_angle(-car.facing_angle + ray_angles[ii])
-                        intersect = ray.multi_cast((track.inner_border_geometry,
-                        track.outer_border_geometry))
-                        input.append(intersect[0])
-                        
-                    # Get control inputs from the AI, move the car, and calculate any
-                    # collisions or checkpoint passes
-                    input += (car.speed, car.angle_delta, car.last_cp[1])
-                    output = nets[i].activate(input)
-
-                    if output[0] > TRAINING_CONFIG["STEERING_SNAP"]:
-                        steering_input = 1
-                    elif output[0] < -TRAINING_CONFIG["STEERING_SNAP"]:
-                        steering_input = -1
-                    else:
-                        steering_input = 0
-
-                    if output[1] > TRAINING_CONFIG["THROTTLE_SNAP"]:
-                        throttle = 1
-                    elif output[1] < -TRAINING_CONFIG["THROTTLE_SNAP"]\
-                        and TRAINING_CONFIG["ALLOW_BRAKING"]:
-                        throttle = -1
-                    else:
-                        throttle = 0
-
-                    car.move(throttle, steering_input)
-
-                    border_collision, new_checkpoint, new_lap =\
-                        track.collide(car.hitbox, car.passed_checkpoints)
-
-                    # Kill the AI if its car hits the track walls
-                    if border_collision:
-                        ge[i].fitness -= TRAINING_CONFIG["DEATH_PENALTY"]
-                        cars.pop(i)
-                        car_rays.pop(i)
-                        car_multipliers.pop(i)
-                        nets.pop(i)
-                        ge.pop(i)
-                        continue
-
-                    # Assign fitness values
-                    if new_checkpoint != -1:
-                        # If the car has passed a checkpoint, increase its fitness based
-                        # on the time multiplier, then reset the time multiplier
-                        score = TRAINING_CONFIG["CHECKPOINT_SCORE"] * car_multipliers[i]
-                        ge[i].fitness += score
-                        car_multipliers[i] = TRAINING_CONFIG["MAX_TIME_MULTIPLIER"]
-
-                        # Add the checkpoint to the list of checkpoints the car has passed.
-                        car.passed_checkpoints.append(new_checkpoint)
-
-                        # Reset the car's passed checkpoints if it completes a lap
-                        if new_lap:
-                            car.passed_checkpoints = []
-                        
-                        # Reset the car's distance to the next checkpoint
-                        car.last_cp_distance = find_nearest_cp(track, car)
-
-                    else:
-                        # Decrease the car's time multiplier to a minimum of 1
-                        car_multipliers[i] -= TRAINING_CONFIG["TIME_MULTIPLIER_DECAY"]
-                        if car_multipliers[i] < 1:
-                            car_multipliers[i] = 1
-
-                        # Alter the AI's fitness based on its distance to the next checkpoint
-                        new_distance = find_nearest_cp(track, car)
-                        if new_distance[0] < car.last_cp[0]:
-                            ge[i].fitness += (car.last_cp[0] - new_distance[0])\
-                                                * TRAINING_CONFIG["CHECKPOINT_ADVANCE_SCORE"]
-                            car.last_cp[0] = new_distance[0]
-                        car.last_cp[1] = new_distance[1]
-
-                if len(cars) == 0:
-                    running = False
+        if not updated:
+            continue
 
         # Refresh the display
+        profiler.begin("frame")
         window.fill(GAME_CONFIG["BACKGROUND_COLOR"])
 
         track.display()
-        for i, car in enumerate(cars):
-            car.display()
-            if GAME_CONFIG["SHOW_RAYS"]:
-                for ray in car_rays[i]:
+        shown_cars = sim.leaders(GAME_CONFIG["DRAW_TOP_CARS"])
+        sim.cars.display(shown_cars)
+        if sim.show_rays:
+            for i in shown_cars:
+                for ray in sim.car_rays[i]:
                     ray.display()
 
         pg.display.update()
-
-def run(config_path:Path) -> None:
-    config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction, neat.DefaultSpeciesSet,
-                neat.DefaultStagnation, config_path)
-
-    p = neat.Population(config)
-    p.add_reporter(neat.StdOutReporter(True))
-    p.add_reporter(neat.StatisticsReporter())
-    
-    winner = p.run(main, TRAINING_CONFIG["NUM_GENERATIONS"])
+        profiler.lap("rendering")
+
+# Only used in headless mode, when training is split across multiple processes (or computers) or cached
+evaluator = None
+# Times each part of the simulation, and gets reported after each generation
+profiler = PhaseProfiler(TRAINING_CONFIG["PROFILE_EVERY"])
+# Decides where each generation gets recorded, when RECORD_TRAJECTORIES is on
+recordings = None
+
+# Everything main.py needs to save in a checkpoint, besides the population itself
+def training_state(stdout:neat.StdOutReporter, stats:neat.StatisticsReporter) -> Dict:
+    return {
+        "current_track": current_track,
+        "generations_since_change": generations_since_change,
+        "stdout": stdout,
+        "stats": stats,
+    }
+
+# Trains for NUM_GENERATIONS generations. If a checkpoint is given, training carries on from it
+# instead of starting over (and only runs however many generations it has left).
+def run(config_path:Path, resume:Path=None) -> None:
+    global evaluator, recordings, current_track, generations_since_change
+    setup()
+    # The workers can't draw anything, so training only gets split up (or cached) in headless mode
+    if GAME_CONFIG["HEADLESS"] and TRAINING_CONFIG["DISTRIBUTED"]:
+        evaluator = DistributedEvaluator(TRAINING_CONFIG["DISTRIBUTED_HOST"], TRAINING_CONFIG["DISTRIBUTED_PORT"],
+                                         TRAINING_CONFIG["DISTRIBUTED_KEY"], max(len(evaluation_tracks), 1),
+                                         TRAINING_CONFIG["FITNESS_CACHE_SIZE"], TRAINING_CONFIG["DISTRIBUTED_TIMEOUT"])
+    elif GAME_CONFIG["HEADLESS"] and (TRAINING_CONFIG["WORKERS"] != 1 or TRAINING_CONFIG["FITNESS_CACHE_SIZE"] > 0):
+        evaluator = PoolEvaluator(TRAINING_CONFIG["WORKERS"], max(len(evaluation_tracks), 1),
+                                  TRAINING_CONFIG["FITNESS_CACHE_SIZE"])
+
+    if resume is None:
+        config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction, neat.DefaultSpeciesSet,
+                    neat.DefaultStagnation, config_path)
+        p = neat.Population(config)
+        stdout = neat.StdOutReporter(True)
+        stats = neat.StatisticsReporter()
+    else:
+        print(f"Resuming from {resume}")
+        snapshot = load_checkpoint(resume)
+        p = restore_population(snapshot)
+        state = snapshot["state"]
+        current_track = state["current_track"]
+        generations_since_change = state["generations_since_change"]
+        stdout = state["stdout"]
+        stats = state["stats"]
+
+    p.add_reporter(stdout)
+    p.add_reporter(stats)
+    if TRAINING_CONFIG["PROFILE_EVERY"] > 0:
+        p.add_reporter(ProfileReporter(profiler))
+    if TRAINING_CONFIG["RECORD_TRAJECTORIES"]:
+        recordings = RecordingReporter(TRAINING_CONFIG["RECORDING_DIR"], TRAINING_CONFIG["RECORDINGS_KEPT"])
+        p.add_reporter(recordings)
+    checkpointer = TrainingCheckpointer(p, TRAINING_CONFIG["CHECKPOINT_EVERY"], TRAINING_CONFIG["CHECKPOINT_DIR"],
+                                        TRAINING_CONFIG["CHECKPOINTS_KEPT"], lambda: training_state(stdout, stats))
+    p.add_reporter(checkpointer)
+
+    try:
+        winner = p.run(main, max(TRAINING_CONFIG["NUM_GENERATIONS"] - p.generation, 0))
+    finally:
+        checkpointer.wait()
+        if evaluator is not None:
+            evaluator.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trains the AI.")
+    parser.add_argument("--resume", nargs="?", const="latest", type=str, metavar="CHECKPOINT",
+                        help="Carry on from a checkpoint (the newest one in CHECKPOINT_DIR if none is given).")
+    args = parser.parse_args()
+
+    resume = None
+    if args.resume == "latest":
+        resume = latest_checkpoint(TRAINING_CONFIG["CHECKPOINT_DIR"])
+        if resume is None:
+            parser.error(f"There are no checkpoints in {TRAINING_CONFIG['CHECKPOINT_DIR']} to resume from")
+    elif args.resume is not None:
+        resume = Path(args.resume)
+
     config_path = Path("neat_config.txt")
-    run(config_path)
\ No newline at end of file
+    run(config_path, resume)
\ No newline at end of file
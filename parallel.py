@@ -0,0 +1,312 @@
+# Splits a generation across multiple processes so training can use more than one core.
+# Every worker runs a headless Simulation of its share of the population, and the results
+# are exactly the same as running the whole population in a single Simulation.
+
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Connection, Listener, wait
+from pathlib import Path
+from typing import Dict, List, Tuple
+import numpy as np
+import neat
+from simulation import *
+from recording import TrajectoryRecorder
+from fitnesscache import FitnessCache, genome_key, share_outcomes
+from profiler import PhaseProfiler
+from distributed import DEFAULT_KEY, fingerprint, is_local, save_recording
+from settings import ConfigError, ConfigSection, load_config
+from trackfile import load_track
+
+# Shared between every worker. Holds the earliest update where a car stopped moving on each
+# track being run, which is when the generation ends on that track (see Simulation.tick). Set up
+# once per worker process, along with the training process's config. Pool workers on Linux are
+# forked from the training process, so they already have it (and everything imported with it).
+# Ones that get started fresh instead (Windows and macOS) import main.py again first, which loads
+# the same checked config.txt from __pycache__, and then use the handed in one for everything else.
+NO_STALL = 2**62
+stall_ticks = None
+
+def init_worker(shared_stall_ticks, config:ConfigSection) -> None:
+    global stall_ticks
+    stall_ticks = shared_stall_ticks
+    load_config(config=config)
+
+# Runs one share of the population on one track (slot is which entry of stall_ticks belongs to
+# that track). Cars in "resumed" pick up from a cached outcome instead of starting over (see
+# fitnesscache.py). If record_path is given, everything the cars do gets recorded there (see
+# recording.py). Returns the fitness of every car after each update (so the results can be cut
+# off at the update where some car in another share stopped moving), the update where a car in
+# this share stopped moving (or None), the final fitness values, how long each part of the
+# simulation took, the update each car died on, and the state of every car that's still alive.
+def evaluate_share(genomes:List, config:neat.Config, track_path:Path, slot:int, resumed:List=(),
+                   record_path:Path=None) -> Tuple:
+    profiler = PhaseProfiler(TRAINING_CONFIG["PROFILE_EVERY"])
+    recorder = None
+    if record_path is not None:
+        recorder = TrajectoryRecorder(record_path, genomes, track_path, ray_angles)
+    sim = Simulation(load_track(track_path), genomes, config, profiler=profiler, recorder=recorder)
+    for i, (cached_history, _, _, state) in resumed:
+        sim.resume_car(i, len(cached_history) - 1, state)
+
+    history = [sim.fitness.copy()]
+    while sim.running:
+        # Some other car already stopped moving, so nothing after this point counts. The update
+        # where it stopped still has to run here though, in case cars in this share stopped too.
+        if sim.ticks > stall_ticks[slot]:
+            break
+
+        sim.tick()
+        if sim.stalled:
+            with stall_ticks.get_lock():
+                stall_ticks[slot] = min(stall_ticks[slot], sim.ticks)
+            break
+        history.append(sim.fitness.copy())
+    if recorder is not None:
+        recorder.close(sim.death_ticks, sim.fitness)
+
+    # Resumed cars' fitness from before they started up again comes from the cache (including the
+    # final fitness of any that never got to start again)
+    history = np.array(history)
+    final_fitness = sim.fitness.copy()
+    for i, (cached_history, _, _, _) in resumed:
+        rows = min(len(history), len(cached_history))
+        history[:rows, i] = cached_history[:rows]
+    for waiting in sim.resuming.values():
+        for i, _ in waiting:
+            final_fitness[i] = history[-1, i]
+
+    states = [sim.car_state(i) if alive else None for i, alive in enumerate(sim.cars.alive.tolist())]
+    return (history, sim.ticks if sim.stalled else None, final_fitness, profiler, sim.death_ticks, states)
+
+
+# Owns a pool of worker processes, which is kept around for the whole training run so the
+# workers only have to start up once. max_tracks is the most tracks a generation can be run on.
+# With only one worker, everything runs in this process instead. If cache_size isn't 0, that many
+# genomes' results get remembered so they don't have to be simulated again (see fitnesscache.py).
+class PoolEvaluator:
+    def __init__(self, workers:int, max_tracks:int=1, cache_size:int=0) -> None:
+        if workers <= 0:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.stall_ticks = mp.Array("q", [NO_STALL] * max_tracks)
+        self.cache = FitnessCache(cache_size) if cache_size > 0 else None
+        if workers == 1:
+            self.pool = None
+            init_worker(self.stall_ticks, load_config())
+        else:
+            self.pool = mp.Pool(workers, initializer=init_worker, initargs=(self.stall_ticks, load_config()))
+
+    # Sets the fitness of every genome, same as running a Simulation of all of them on each track
+    # and combining the results with combine_fitness would. Takes compiled tracks' files (see
+    # trackfile.py), which each worker only loads the first time it gets them. If a profiler is
+    # given, the time each worker spent on each part of the simulation gets added to it. If
+    # record_dir is given, every share gets recorded into a file there (see recording.py).
+    def evaluate(self, genomes:List, config:neat.Config, track_paths:List[Path], profiler:PhaseProfiler=None,
+                combine:str="mean", record_dir:Path=None) -> None:
+        if len(track_paths) > len(self.stall_ticks):
+            raise ValueError(f"Can't run {len(track_paths)} tracks at once, the most is {len(self.stall_ticks)}")
+
+        # Genomes whose cars already died in a cached run don't get run again. They still end the
+        # generation wherever they stopped moving though, so the shares that do get run stop there
+        # too. Cached cars that were still alive get run, but only from where the cache left off.
+        runs = [[] for _ in track_paths]
+        to_simulate = []
+        if self.cache is not None:
+            keys = [genome_key(g) for _, g in genomes]
+        for slot, track_path in enumerate(track_paths):
+            self.stall_ticks[slot] = NO_STALL
+            to_simulate.append([])
+            for i in range(len(genomes)):
+                outcome = None if self.cache is None else self.cache.get(self.cache.key(keys[i], track_path))
+                if outcome is None or outcome[3] is not None:
+                    to_simulate[slot].append((i, outcome))
+                    continue
+                history, stall, final_fitness, _ = outcome
+                runs[slot].append(([i], history[:, np.newaxis], stall, np.array([final_fitness])))
+                if stall is not None:
+                    self.stall_ticks[slot] = min(self.stall_ticks[slot], stall)
+
+        # Every track is split into fewer shares when there's more than one, so the tracks all get
+        # run at the same time instead of one after another. Every update takes about as long no
+        # matter how many cars there are, so this is faster than splitting every track evenly.
+        share_count = max(self.workers // len(track_paths), 1)
+        jobs = [(slot, i, cars[i::share_count]) for slot, cars in enumerate(to_simulate)
+                for i in range(share_count) if len(cars[i::share_count]) > 0]
+        args = [([genomes[i] for i, _ in cars], config, track_paths[slot], slot,
+                 [(row, outcome) for row, (_, outcome) in enumerate(cars) if outcome is not None],
+                 None if record_dir is None else Path(record_dir) / f"track{slot}-share{share}.rec")
+                for slot, share, cars in jobs]
+        results = self.run_shares(args)
+
+        for (slot, _, cars), (history, share_stall, final_fitness, share_profiler, death_ticks, states) in zip(jobs, results):
+            indices = [i for i, _ in cars]
+            runs[slot].append((indices, history, share_stall, final_fitness))
+            if profiler is not None:
+                profiler.merge(share_profiler)
+            if self.cache is not None:
+                outcomes = share_outcomes(history, share_stall, final_fitness, death_ticks, states)
+                for i, outcome in zip(indices, outcomes):
+                    if outcome is not None:
+                        self.cache.put(self.cache.key(keys[i], track_paths[slot]), outcome)
+
+        # The generation ends at the first update where any car stopped moving on that track.
+        # Shares that kept going past that point get their fitness from that update instead of the end.
+        fitness = np.zeros((len(track_paths), len(genomes)))
+        for slot, track_runs in enumerate(runs):
+            end_tick = min([stall for _, _, stall, _ in track_runs if stall is not None], default=NO_STALL)
+            for indices, history, stall, final_fitness in track_runs:
+                if stall != end_tick:
+                    final_fitness = history[min(end_tick, len(history) - 1)]
+                fitness[slot, indices] = final_fitness
+
+        for (_, g), value in zip(genomes, combine_fitness(fitness, combine).tolist()):
+            g.fitness = value
+
+    # Runs evaluate_share with each set of arguments, and returns the results in the same order
+    def run_shares(self, args:List[Tuple]) -> List[Tuple]:
+        if self.pool is None:
+            return [evaluate_share(*share_args) for share_args in args]
+        return self.pool.starmap(evaluate_share, args)
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+# Hands out shares to workers on other computers (or this one) instead of a pool, for populations
+# too big for one computer. This is the coordinator side, see distributed.py for how it all works.
+class DistributedEvaluator(PoolEvaluator):
+    # Listens for workers on "host" and "port" ("0.0.0.0" for every network this computer is on).
+    # Shares get handed back out if a worker hasn't sent anything for "timeout" seconds (workers
+    # send a message every timeout / 4 seconds while they're working).
+    def __init__(self, host:str, port:int, key:str, max_tracks:int=1, cache_size:int=0, timeout:float=60) -> None:
+        if key == DEFAULT_KEY and not is_local(host):
+            raise ConfigError(f"DISTRIBUTED_HOST is {host!r}, so other computers could connect, but DISTRIBUTED_KEY "
+                              f"is still the default. Change DISTRIBUTED_KEY first.")
+        super().__init__(1, max_tracks, cache_size)
+        self.port = port
+        self.timeout = timeout
+        # Workers get this process's config, so they don't need the same config.txt
+        self.hello = ("hello", fingerprint(), load_config(), max_tracks, timeout / 4)
+        # Every connected worker, and the compiled tracks it's already been sent
+        self.connections = {}
+        # Workers get accepted (and checked) on a separate thread, and picked up from here
+        self.new_connections = queue.Queue()
+        self.listener = Listener((host, port), authkey=key.encode())
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        while True:
+            try:
+                conn = self.listener.accept()
+            except mp.AuthenticationError:
+                print("A worker tried to connect with the wrong DISTRIBUTED_KEY")
+                continue
+            except OSError:
+                # The listener got closed
+                return
+            try:
+                conn.send(self.hello)
+                if conn.poll(self.timeout) and conn.recv() == ("ready",):
+                    self.new_connections.put(conn)
+                    continue
+            except (EOFError, OSError):
+                pass
+            conn.close()
+
+    # Picks up any workers that connected since last time. If block is True and there aren't any
+    # workers at all, waits for one to connect.
+    def add_workers(self, block:bool=False) -> None:
+        if block and not self.connections and self.new_connections.empty():
+            print(f"Waiting for a worker to connect on port {self.port} (start one with: python distributed.py <address>)")
+            self.connections[self.new_connections.get()] = set()
+        while not self.new_connections.empty():
+            self.connections[self.new_connections.get()] = set()
+
+    def drop(self, conn:Connection) -> None:
+        del self.connections[conn]
+        conn.close()
+
+    def evaluate(self, genomes:List, config, track_paths:List[Path], profiler=None, combine:str="mean",
+                 record_dir:Path=None) -> None:
+        # Every generation gets split into one share for each worker
+        self.add_workers(block=True)
+        self.workers = len(self.connections)
+        super().evaluate(genomes, config, track_paths, profiler, combine, record_dir)
+
+    def run_shares(self, args:List[Tuple]) -> List[Tuple]:
+        results = [None] * len(args)
+        waiting = deque(range(len(args)))
+        # The share each busy worker is running, and when it was last heard from
+        running = {}
+        last_heard = {}
+        while any(i is None for i in results):
+            self.add_workers(block=not self.connections)
+
+            # Hand out shares to every worker that isn't busy
+            for conn, sent_tracks in list(self.connections.items()):
+                if conn in running or not waiting:
+                    continue
+                share = waiting.popleft()
+                genomes, config, track_path, slot, resumed, record_path = args[share]
+                track_path = Path(track_path)
+                # Workers might not have the track, so it gets sent along the first time each one needs it
+                track = None if track_path.name in sent_tracks else track_path.read_bytes()
+                # The worker can stop early if some car already stopped moving in a share that's finished
+                task = (genomes, config, track_path.name, slot, resumed, record_path is not None,
+                        self.stall_ticks[slot])
+                try:
+                    conn.send(("share", share, task, track))
+                except OSError:
+                    waiting.appendleft(share)
+                    self.drop(conn)
+                    continue
+                sent_tracks.add(track_path.name)
+                running[conn] = share
+                last_heard[conn] = time.monotonic()
+
+            for conn in wait(list(self.connections), timeout=1):
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    message = None
+                if message is None:
+                    print("A worker disconnected")
+                    if conn in running:
+                        waiting.appendleft(running.pop(conn))
+                    self.drop(conn)
+                    continue
+                last_heard[conn] = time.monotonic()
+                if message[0] == "share":
+                    _, share, result, recording = message
+                    running.pop(conn)
+                    results[share] = result
+                    slot = args[share][3]
+                    if result[1] is not None:
+                        self.stall_ticks[slot] = min(self.stall_ticks[slot], result[1])
+                    if recording is not None:
+                        save_recording(recording, args[share][5])
+
+            now = time.monotonic()
+            for conn, share in list(running.items()):
+                if now - last_heard[conn] > self.timeout:
+                    print(f"A worker hasn't responded in {self.timeout} seconds, giving its share to another one")
+                    waiting.appendleft(running.pop(conn))
+                    self.drop(conn)
+        return results
+
+    def close(self) -> None:
+        self.listener.close()
+        self.add_workers()
+        for conn in list(self.connections):
+            try:
+                conn.send(("stop",))
+            except OSError:
+                pass
+            self.drop(conn)
+        super().close()
@@ -0,0 +1,79 @@
+# Keeps track of how much time each part ("phase") of the simulation takes, so it's easy to see
+# where the time goes when training is slow. To keep it cheap enough to leave on all the time, only
+# one out of every sample_every updates is actually timed, and the total time for each phase is
+# estimated from those. Call counts are always exact.
+
+from time import perf_counter
+from typing import Dict
+import neat
+
+class PhaseProfiler:
+    # Set sample_every to 0 to turn profiling off completely
+    def __init__(self, sample_every:int=1) -> None:
+        self.sample_every = sample_every
+        self.reset()
+
+    # Clears everything that's been recorded so far
+    def reset(self) -> None:
+        self.sampled_time = {}  # Total time of the samples for each phase
+        self.samples = {}       # How many times each phase was timed
+        self.calls = {}         # How many times each phase actually ran
+        self.counters = {}
+        self.sampling = False
+        self.last_time = 0
+
+    # Starts a group of phases, like one update or one frame. Phases are timed from the end of the
+    # one before them, so each group needs to start with this. Every kind of group is sampled
+    # separately, so ones that take turns with each other (like updates and frames) all get timed.
+    def begin(self, group:str) -> None:
+        if self.sample_every <= 0:
+            return
+        count = self.counters.get(group, 0)
+        self.counters[group] = count + 1
+        self.sampling = count % self.sample_every == 0
+        if self.sampling:
+            self.last_time = perf_counter()
+
+    # Marks the end of a phase
+    def lap(self, phase:str) -> None:
+        if self.sample_every <= 0:
+            return
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        if self.sampling:
+            now = perf_counter()
+            self.sampled_time[phase] = self.sampled_time.get(phase, 0) + now - self.last_time
+            self.samples[phase] = self.samples.get(phase, 0) + 1
+            self.last_time = now
+
+    # Adds everything another profiler recorded into this one (used to collect the results from
+    # worker processes).
+    def merge(self, other:"PhaseProfiler") -> None:
+        for totals, other_totals in ((self.sampled_time, other.sampled_time), (self.samples, other.samples),
+                                     (self.calls, other.calls)):
+            for phase, value in other_totals.items():
+                totals[phase] = totals.get(phase, 0) + value
+
+    # Returns the estimated total time (in seconds) and number of calls for each phase
+    def results(self) -> Dict[str, Dict[str, float]]:
+        return {phase: {"seconds": self.sampled_time.get(phase, 0) / self.samples[phase] * calls
+                                   if self.samples.get(phase) else 0.0,
+                        "calls": calls}
+                for phase, calls in self.calls.items()}
+
+
+# Prints how long each phase took after every generation (next to what StdOutReporter prints),
+# then starts over for the next one. With multiple worker processes, times are added up across
+# every worker, so they can be more than the generation actually took.
+class ProfileReporter(neat.reporting.BaseReporter):
+    def __init__(self, profiler:PhaseProfiler) -> None:
+        self.profiler = profiler
+
+    def post_evaluate(self, config, population, species, best_genome) -> None:
+        results = self.profiler.results()
+        total = sum(i["seconds"] for i in results.values())
+        if total > 0:
+            print("Time per phase:")
+            for phase, result in sorted(results.items(), key=lambda i: -i[1]["seconds"]):
+                print(f"    {phase:<12} {result['seconds']:8.3f} sec ({result['seconds'] / total:6.1%}) "
+                      f"in {result['calls']} calls")
+        self.profiler.reset()
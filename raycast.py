@@ -1,29 +1,31 @@
-import pygame as pg
 from shapely.geometry import LineString, Point, LinearRing
 from shapely.affinity import rotate, translate
-from typing import Tuple
-# I know there's an official python library for this (configparser), but configobj has more options and supports things like nested config sections.
-from configobj import ConfigObj
-from ast import literal_eval
-r_cfg = ConfigObj("config.txt")["RAYCASTING"]
+from typing import Tuple, TYPE_CHECKING
+import numpy as np
+from spatial import SegmentGrid, ray_segment_distances
+from settings import load_config
+# Only needed for the type hints, pygame itself is only loaded when something gets drawn (see render.py)
+if TYPE_CHECKING:
+    import pygame as pg
+r_cfg = load_config().RAYCASTING
 
 
 class Ray:
-    (CAST_LENGTH,
-     TRUNCATE_RAY,
-     RAY_COLOR,
-     RAY_WIDTH,
-     SHOW_INTERSECTION,
-     INTERSECT_RADIUS,
-     INTERSECT_COLOR,
-     SHOW_DISTANCE,
-     DISTANCE_DECIMALS) = [literal_eval(value) for _, value in r_cfg.items()]
+    CAST_LENGTH = r_cfg.CAST_LENGTH
+    TRUNCATE_RAY = r_cfg.TRUNCATE_RAY
+    RAY_COLOR = r_cfg.RAY_COLOR
+    RAY_WIDTH = r_cfg.RAY_WIDTH
+    SHOW_INTERSECTION = r_cfg.SHOW_INTERSECTION
+    INTERSECT_RADIUS = r_cfg.INTERSECT_RADIUS
+    INTERSECT_COLOR = r_cfg.INTERSECT_COLOR
+    SHOW_DISTANCE = r_cfg.SHOW_DISTANCE
+    DISTANCE_DECIMALS = r_cfg.DISTANCE_DECIMALS
     
     # String operator for rounding to a specified number of decimal places
     ROUNDING_STRING = f'%.{DISTANCE_DECIMALS}f'
 
     BASE_LINE = LineString(((0, 0), (0, CAST_LENGTH)))  # This is copied and moved to create the rays used for casting.
-    def __init__(self, surface:pg.surface.Surface, font:pg.font.SysFont, origin:Tuple[float,float], angle:float) -> None:
+    def __init__(self, surface:"pg.surface.Surface", font:"pg.font.Font", origin:Tuple[float,float], angle:float) -> None:
         self.surface = surface
         self.font = font
         self.origin = Point(origin)
@@ -83,16 +85,8 @@ class Ray:
 
 
     def display(self) -> None:
-        if self.TRUNCATE_RAY and self.last_intersection != None:
-            pg.draw.line(self.surface, self.RAY_COLOR, self.ray.coords[0], self.last_intersection, self.RAY_WIDTH)
-        else:
-            pg.draw.line(self.surface, self.RAY_COLOR, self.ray.coords[0], self.ray.coords[1], self.RAY_WIDTH)
-
-        if self.SHOW_INTERSECTION and self.last_intersection != None:
-            pg.draw.circle(self.surface, self.INTERSECT_COLOR, self.last_intersection, self.INTERSECT_RADIUS)
-            if self.SHOW_DISTANCE and self.last_distance != self.CAST_LENGTH:
-                img = self.font.render(self.ROUNDING_STRING % self.last_distance, True, self.INTERSECT_COLOR)
-                self.surface.blit(img, (self.last_intersection[0] + 10, self.last_intersection[1]))
+        from render import draw_ray
+        draw_ray(self.surface, self.font, self)
 
 
     def set_angle(self, new_angle:float, relative:bool=False) -> None:
@@ -102,10 +96,55 @@ class Ray:
             self.angle = new_angle
         self.__update_ray()
 
+    # Moves the ray and sets the result of a cast without actually casting it. Used to display
+    # rays whose distances were found with batch_cast.
+    def set_cast(self, origin:Tuple[float,float], angle:float, distance:float) -> None:
+        self.origin = Point(origin)
+        self.angle = angle
+        self.__update_ray()
+        if distance < 0:
+            self.last_distance = self.CAST_LENGTH
+            self.last_intersection = None
+        else:
+            ray_start, ray_end = self.ray.coords
+            scale = distance / self.CAST_LENGTH
+            self.last_distance = distance
+            self.last_intersection = (ray_start[0] + (ray_end[0] - ray_start[0]) * scale,
+                                      ray_start[1] + (ray_end[1] - ray_start[1]) * scale)
+
     def set_origin(self, new_origin:Tuple[float, float], relative:bool=False) -> None:
         if relative:
             old_origin = self.origin.coords
             self.origin = Point((old_origin[0] + new_origin[0], old_origin[1] + new_origin[1]))
         else:
             self.origin = Point(new_origin)
-        self.__update_ray()
\ No newline at end of file
+        self.__update_ray()
+
+# Casts a whole population's worth of rays at once, which is much faster than casting
+# them one at a time. Origins are an (N, 2) array of positions, angles are an (N, R)
+# array of ray angles (the same angles a Ray would use), and segments are an (S, 4)
+# array of line segments, with each row being (x1, y1, x2, y2).
+# If a SegmentGrid built from the same segments is given, rays only get tested against
+# the segments in the grid cells they pass through instead of every segment. A track's
+# DistanceField can be given instead of a grid too, which is approximate but doesn't care
+# how many segments the track has.
+# Returns an (N, R) array of distances to the closest segment each ray hits. Just like
+# Ray.multi_cast, rays that don't hit anything get a distance of -1.
+def batch_cast(origins:np.ndarray, angles:np.ndarray, segments:np.ndarray, grid:SegmentGrid=None) -> np.ndarray:
+    angles = np.radians(angles)
+    # Rays are cast along the y axis and then rotated, same as Ray.BASE_LINE.
+    dir_x = -np.sin(angles)
+    dir_y = np.cos(angles)
+
+    if grid is not None:
+        flat_origins = np.repeat(origins, angles.shape[1], axis=0)
+        directions = np.column_stack((dir_x.ravel(), dir_y.ravel()))
+        closest = grid.cast(flat_origins, directions, Ray.CAST_LENGTH).reshape(angles.shape)
+    else:
+        distances = ray_segment_distances(origins[:, 0, np.newaxis, np.newaxis], origins[:, 1, np.newaxis, np.newaxis],
+                                          dir_x[:, :, np.newaxis], dir_y[:, :, np.newaxis],
+                                          segments, Ray.CAST_LENGTH)
+        closest = distances.min(axis=2, initial=np.inf)
+
+    closest[closest == np.inf] = -1
+    return closest
@@ -0,0 +1,136 @@
+# Records everything each car did during a generation (where it was, which way it was facing, what
+# its network decided to do, and what its rays saw), so it can be played back later with replay.py
+# without running any networks or physics again.
+#
+# Every update gets copied into arrays that are set up ahead of time, and they get written to disk
+# every CHUNK_TICKS updates, so recording barely slows training down at all. A recording is just a
+# series of .npy arrays one after another in the same file: a header (JSON), then the chunks of
+# updates, then a footer with how each car ended up.
+
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Tuple
+import numpy as np
+import neat
+
+# Changing what goes into a recording means older ones can't be played back anymore
+VERSION = 1
+CHUNK_TICKS = 256
+
+# Everything recorded about every car on each update, as a NumPy structured type
+def frame_type(car_count:int, ray_count:int) -> np.dtype:
+    return np.dtype([
+        ("position", "<f4", (car_count, 2)),
+        ("facing_angle", "<f4", (car_count,)),
+        ("velocity_angle", "<f4", (car_count,)),
+        ("speed", "<f4", (car_count,)),
+        ("angle_delta", "<f4", (car_count,)),
+        ("steering", "i1", (car_count,)),
+        ("throttle", "i1", (car_count,)),
+        ("rays", "<f4", (car_count, ray_count)),
+        ("alive", "?", (car_count,)),
+    ])
+
+FOOTER_TYPE = np.dtype([("genome", "<i8"), ("death_tick", "<i8"), ("fitness", "<f8")])
+
+
+class TrajectoryRecorder:
+    # Records a Simulation of the given genomes on a compiled track (see trackfile.py)
+    def __init__(self, path:Path, genomes:List, track_path:Path, ray_angles:Tuple) -> None:
+        self.path = Path(path)
+        self.genomes = [genome_id for genome_id, _ in genomes]
+        self.chunk = np.zeros(CHUNK_TICKS, dtype=frame_type(len(genomes), len(ray_angles)))
+        self.rows = 0
+
+        # Everything gets written to a temporary file first, so a recording that got cut off
+        # halfway through never looks like a finished one.
+        os.makedirs(self.path.parent, exist_ok=True)
+        self.temp_path = self.path.with_name(self.path.name + ".tmp")
+        self.file = open(self.temp_path, "wb")
+        header = {"version": VERSION, "track": Path(track_path).name, "genomes": self.genomes,
+                  "ray_angles": list(ray_angles)}
+        np.save(self.file, np.frombuffer(json.dumps(header).encode(), dtype=np.uint8))
+
+    # Records one update, before the cars move. alive is which cars are still going, and the rest
+    # is the steering and throttle for every car plus the ray distances for the cars that are still
+    # going (or None if no cars are).
+    def record(self, cars, alive:np.ndarray, steering:np.ndarray, throttle:np.ndarray,
+               distances:np.ndarray) -> None:
+        frame = self.chunk[self.rows]
+        frame["position"] = cars.position
+        frame["facing_angle"] = cars.facing_angle
+        frame["velocity_angle"] = cars.velocity_angle
+        frame["speed"] = cars.speed
+        frame["angle_delta"] = cars.angle_delta
+        frame["alive"] = False
+        frame["alive"][alive] = True
+        if steering is None:
+            frame["steering"] = 0
+            frame["throttle"] = 0
+        else:
+            frame["steering"] = steering
+            frame["throttle"] = throttle
+            frame["rays"][alive] = distances
+
+        self.rows += 1
+        if self.rows == CHUNK_TICKS:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.rows > 0:
+            np.save(self.file, self.chunk[:self.rows])
+            self.rows = 0
+
+    # Finishes the recording once the simulation is over
+    def close(self, death_ticks:np.ndarray, fitness:np.ndarray) -> None:
+        self.flush()
+        footer = np.zeros(len(self.genomes), dtype=FOOTER_TYPE)
+        footer["genome"] = self.genomes
+        footer["death_tick"] = death_ticks
+        footer["fitness"] = fitness
+        np.save(self.file, footer)
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+
+# Loads a whole recording. Returns the header, every update (one row each), and the footer.
+def load_recording(path:Path) -> Tuple[Dict, np.ndarray, np.ndarray]:
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = json.loads(np.load(f).tobytes())
+        if header.get("version") != VERSION:
+            raise ValueError(f"{path} was recorded by a different version and can't be played back")
+        chunks = []
+        footer = None
+        while f.tell() < size:
+            array = np.load(f)
+            if array.dtype == FOOTER_TYPE:
+                footer = array
+            else:
+                chunks.append(array)
+    if footer is None:
+        raise ValueError(f"{path} isn't a complete recording")
+    if not chunks:
+        chunks.append(np.zeros(0, dtype=frame_type(len(header["genomes"]), len(header["ray_angles"]))))
+    return (header, np.concatenate(chunks), footer)
+
+
+# Keeps track of which folder this generation's recordings go in, and deletes the oldest
+# generations' recordings (unless keep is 0).
+class RecordingReporter(neat.reporting.BaseReporter):
+    def __init__(self, directory:Path, keep:int) -> None:
+        self.directory = Path(directory)
+        self.keep = keep
+        self.generation_dir = None
+
+    def start_generation(self, generation:int) -> None:
+        self.generation_dir = self.directory / f"generation-{generation:05d}"
+        # Left over from an older training run
+        shutil.rmtree(self.generation_dir, ignore_errors=True)
+
+    def end_generation(self, config, population, species_set) -> None:
+        if self.keep > 0:
+            for old in sorted(self.directory.glob("generation-*"))[:-self.keep]:
+                shutil.rmtree(old, ignore_errors=True)
@@ -0,0 +1,144 @@
+# Everything that actually draws to the screen. The simulation itself (cars, rays, tracks) doesn't
+# need pygame at all, so this is the only place that imports it (apart from the programs that open a
+# window), and it only gets imported the first time something is displayed. That way headless
+# training and worker processes never have to load pygame, open a window, or load any fonts.
+
+import pygame as pg
+from typing import Tuple
+import numpy as np
+from car import Car, CarBatch, Vector2
+from raycast import Ray
+from track import Track
+
+# Opens the game window, and loads the fonts (which can take several seconds). Returns the window,
+# plus the fonts used for car debug info and ray distances.
+def init_display(size:Tuple[int,int]) -> Tuple[pg.surface.Surface, pg.font.Font, pg.font.Font]:
+    pg.init()
+    default_font = pg.font.SysFont("monospace", 15)
+    ray_distance_font = pg.font.SysFont("monospace", 15)
+    window = pg.display.set_mode(size)
+    pg.display.init()
+    pg.display.update()
+    return (window, default_font, ray_distance_font)
+
+# Pygame has trouble rotating images around their center for some reason.
+def blitRotateCenter(surf, image, topleft, angle):
+
+    rotated_image = pg.transform.rotate(image, angle)
+    new_rect = rotated_image.get_rect(center = image.get_rect(topleft = topleft).center)
+
+    surf.blit(rotated_image, new_rect)
+
+# Car bodies, pre-rotated to every angle a car can be drawn at (see car_sprite). Rotating an image
+# is slow, so this is only done once, the first time a car gets drawn.
+car_sprites = []
+
+# Returns the car body rotated to the closest of Car.SPRITE_ANGLES evenly spaced angles
+def car_sprite(facing_angle:float) -> pg.surface.Surface:
+    if not car_sprites:
+        body = pg.Surface((Car.WIDTH, Car.LENGTH), pg.SRCALPHA)
+        pg.draw.rect(body, Car.BODY_COLOR, pg.rect.Rect(0, 0, Car.WIDTH, Car.LENGTH))
+        car_sprites.extend(pg.transform.rotate(body, i * 360 / Car.SPRITE_ANGLES) for i in range(Car.SPRITE_ANGLES))
+    return car_sprites[round(facing_angle * Car.SPRITE_ANGLES / 360) % Car.SPRITE_ANGLES]
+
+# Draws a single car body (plus any debug info) onto a surface. Used by Car.
+def draw_car(surface:pg.surface.Surface, debug_font:pg.font.Font, position:Vector2, facing_angle:float,
+            velocity_angle:float, speed:float, angle_delta:float) -> None:
+    sprite = car_sprite(facing_angle)
+    surface.blit(sprite, sprite.get_rect(center=(position.x, position.y)))
+    draw_car_debug(surface, debug_font, position, facing_angle, velocity_angle, speed, angle_delta)
+
+# Draws the debug info for a single car, if it's enabled. Shared by Car and CarBatch.
+def draw_car_debug(surface:pg.surface.Surface, debug_font:pg.font.Font, position:Vector2, facing_angle:float,
+                  velocity_angle:float, speed:float, angle_delta:float) -> None:
+    position = pg.Vector2(position.x, position.y)
+    if Car.VECTOR_DEBUG:
+        v_scaled = pg.Vector2(0, speed * 50)
+        v_scaled.rotate_ip(velocity_angle)
+        v_end = (position + v_scaled)
+        pg.draw.line(surface, Car.VELOCITY_COLOR,
+                     (position.x, position.y),
+                     (v_end.x, v_end.y), Car.LINE_WIDTH)
+
+        f_scaled = pg.Vector2(0, speed * 50)
+        f_scaled.rotate_ip(-facing_angle)
+        f_end = (position + f_scaled)
+        pg.draw.line(surface, Car.FACING_COLOR,
+                     (position.x, position.y),
+                     (f_end.x, f_end.y), Car.LINE_WIDTH)
+
+    if Car.DEBUG_TEXT:
+        # pygame fonts can only render one line at a time
+        lines = [
+            f"Current Speed: {speed}",
+            f"Angle Delta: {angle_delta}"
+        ]
+        for i, line in enumerate(lines):
+            img = debug_font.render(line, True, (255, 255, 255))
+            surface.blit(img, (10, i*20))
+
+# Draws the given cars in a batch, or every car that's still alive if none are given
+def draw_cars(surface:pg.surface.Surface, debug_font:pg.font.Font, batch:CarBatch, cars:np.ndarray=None) -> None:
+    if cars is None:
+        cars = np.flatnonzero(batch.alive)
+    # Every body gets drawn with a single blits call
+    car_sprite(0)  # Makes sure the sprites exist
+    angles = np.round(batch.facing_angle[cars] * Car.SPRITE_ANGLES / 360).astype(int) % Car.SPRITE_ANGLES
+    surface.blits([(car_sprites[angle], car_sprites[angle].get_rect(center=tuple(position)))
+                   for angle, position in zip(angles.tolist(), batch.position[cars].tolist())], False)
+
+    if Car.VECTOR_DEBUG or Car.DEBUG_TEXT:
+        for i in cars:
+            draw_car_debug(surface, debug_font, Vector2(*batch.position[i]), batch.facing_angle[i],
+                           batch.velocity_angle[i], batch.speed[i], batch.angle_delta[i])
+
+def draw_ray(surface:pg.surface.Surface, font:pg.font.Font, ray:Ray) -> None:
+    if ray.TRUNCATE_RAY and ray.last_intersection != None:
+        pg.draw.line(surface, ray.RAY_COLOR, ray.ray.coords[0], ray.last_intersection, ray.RAY_WIDTH)
+    else:
+        pg.draw.line(surface, ray.RAY_COLOR, ray.ray.coords[0], ray.ray.coords[1], ray.RAY_WIDTH)
+
+    if ray.SHOW_INTERSECTION and ray.last_intersection != None:
+        pg.draw.circle(surface, ray.INTERSECT_COLOR, ray.last_intersection, ray.INTERSECT_RADIUS)
+        if ray.SHOW_DISTANCE and ray.last_distance != ray.CAST_LENGTH:
+            img = font.render(ray.ROUNDING_STRING % ray.last_distance, True, ray.INTERSECT_COLOR)
+            surface.blit(img, (ray.last_intersection[0] + 10, ray.last_intersection[1]))
+
+# The track never moves, so it gets drawn onto its own transparent surface once and then just
+# copied onto the display. It only gets redrawn if a line needs to change color.
+def draw_track(surface:pg.surface.Surface, track:Track) -> None:
+    state = None
+    if track.SHOW_COLLISIONS:
+        state = (track.inner_border_collision, track.outer_border_collision,
+                 track.finish_line_collision, tuple(track.checkpoint_collisions))
+    if track.layer is None or state != track.layer_state:
+        if track.layer is None:
+            track.layer = pg.Surface(surface.get_size(), pg.SRCALPHA)
+        track.layer.fill((0, 0, 0, 0))
+        draw_track_lines(track.layer, track)
+        track.layer_state = state
+    surface.blit(track.layer, (0, 0))
+
+def draw_track_lines(surface:pg.surface.Surface, track:Track) -> None:
+    if track.SHOW_CHECKPOINTS:
+        finish_color = track.FINISH_LINE_COLOR
+        if track.finish_line_collision and track.SHOW_COLLISIONS:
+            finish_color = track.FINISH_LINE_COLLIDE_COLOR
+        pg.draw.line(surface, finish_color, track.finish_line[0],
+                    track.finish_line[1], track.LINE_WIDTH)
+
+        for i, cp in enumerate(track.checkpoints):
+            cp_color = track.CHECKPOINT_COLOR
+            if i in track.checkpoint_collisions and track.SHOW_COLLISIONS:
+                cp_color = track.CHECKPOINT_COLLIDE_COLOR
+            pg.draw.line(surface, cp_color, cp[0], cp[1], track.LINE_WIDTH)
+
+    inner_color = track.BORDER_COLOR
+    if track.inner_border_collision and track.SHOW_COLLISIONS:
+        inner_color = track.BORDER_COLLIDE_COLOR
+    pg.draw.lines(surface, inner_color, True, track.inner_border, track.LINE_WIDTH)
+
+    outer_color = track.BORDER_COLOR
+    if track.outer_border_collision and track.SHOW_COLLISIONS:
+        outer_color = track.BORDER_COLLIDE_COLOR
+    pg.draw.lines(surface, outer_color, True, track.outer_border, track.LINE_WIDTH)
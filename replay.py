@@ -0,0 +1,151 @@
+# Plays back recordings made with RECORD_TRAJECTORIES (see recording.py), using the same drawing code
+# as main. Nothing gets simulated; the cars just get put wherever they were on each update.
+#
+#     python replay.py                                  plays the newest generation that was recorded
+#     python replay.py recordings/generation-00012 --track 1 --top 5
+#     python replay.py recordings/generation-00012/track0-share1.rec --genomes 31 45
+#
+# Space pauses, and the left and right arrow keys skip back and forward a second.
+
+import argparse
+from pathlib import Path
+from typing import Dict, List, Tuple
+import numpy as np
+from car import CarBatch
+from raycast import Ray
+from recording import load_recording
+from simulation import TICKS_PER_SECOND
+from trackfile import COMPILED_DIR, TRACKS_FILE, TrackStore, load_track
+
+from settings import load_config
+GAME_CONFIG = load_config().GAME
+TRAINING_CONFIG = load_config().AI_TRAINING
+
+# Loads every recording of the same track from a generation (one for each share it was split into),
+# and puts them together as if all the cars were in one. Returns the header, each field's values
+# on each update (one row per update and one column per car), and the footers.
+def load_recordings(paths:List[Path]) -> Tuple[Dict, Dict[str, np.ndarray], np.ndarray]:
+    recordings = [load_recording(path) for path in paths]
+    header = recordings[0][0]
+    if any(i[0]["track"] != header["track"] for i in recordings):
+        raise ValueError("Those recordings aren't all on the same track")
+
+    # Shares can end at different updates. Cars in shares that ended early just stay where they are.
+    length = max(len(frames) for _, frames, _ in recordings)
+    fields = {}
+    for name in recordings[0][1].dtype.names:
+        parts = []
+        for _, frames, _ in recordings:
+            values = frames[name]
+            if len(values) > 0:
+                padding = np.repeat(values[-1:], length - len(values), axis=0)
+            else:
+                padding = np.zeros((length,) + values.shape[1:], dtype=values.dtype)
+            if name == "alive":
+                padding[:] = False
+            parts.append(np.concatenate((values, padding)))
+        fields[name] = np.concatenate(parts, axis=1)
+    header = dict(header, genomes=[genome for i in recordings for genome in i[0]["genomes"]])
+    return (header, fields, np.concatenate([footer for _, _, footer in recordings]))
+
+
+def replay(paths:List[Path], genomes:List[int]=None, top:int=0, speed:float=1) -> None:
+    header, fields, footer = load_recordings(paths)
+    shown = np.arange(len(footer))
+    if genomes:
+        shown = np.flatnonzero(np.isin(footer["genome"], genomes))
+    if top > 0:
+        shown = shown[np.argsort(-footer["fitness"][shown], kind="stable")[:top]]
+    if len(shown) == 0:
+        raise ValueError("None of those genomes are in the recording")
+    print(f"Showing {len(shown)} cars over {len(fields['alive'])} updates")
+
+    import pygame as pg
+    from render import init_display
+    window, default_font, ray_distance_font = init_display((1080, 720))
+    track_path = COMPILED_DIR / header["track"]
+    if not track_path.exists():
+        track_store = TrackStore()
+        track_id = track_store.find(track_path)
+        if track_id is None:
+            raise ValueError(f"The track in the recording ({header['track']}) isn't in {TRACKS_FILE} anymore")
+        track_path = track_store.path(track_id)
+    track = load_track(track_path, window, (1080, 720))
+
+    cars = CarBatch(window, default_font, len(shown), track.start_point, track.start_angle)
+    ray_angles = np.array(header["ray_angles"], dtype=float)
+    rays = []
+    if GAME_CONFIG["SHOW_RAYS"]:
+        rays = [[Ray(window, ray_distance_font, track.start_point, -track.start_angle + i) for i in ray_angles]
+                for _ in shown]
+
+    clock = pg.time.Clock()
+    tick = 0
+    paused = False
+    length = len(fields["alive"])
+    while True:
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                pg.quit()
+                return
+            elif event.type == pg.KEYDOWN:
+                if event.key == pg.K_SPACE:
+                    paused = not paused
+                elif event.key == pg.K_LEFT:
+                    tick = max(tick - TICKS_PER_SECOND, 0)
+                elif event.key == pg.K_RIGHT:
+                    tick = min(tick + TICKS_PER_SECOND, length - 1)
+
+        if length > 0:
+            cars.position = fields["position"][tick, shown].astype(float)
+            cars.facing_angle = fields["facing_angle"][tick, shown].astype(float)
+            cars.velocity_angle = fields["velocity_angle"][tick, shown].astype(float)
+            cars.speed = fields["speed"][tick, shown].astype(float)
+            cars.angle_delta = fields["angle_delta"][tick, shown].astype(float)
+            cars.alive = fields["alive"][tick, shown]
+
+        window.fill(GAME_CONFIG["BACKGROUND_COLOR"])
+        track.display()
+        cars.display()
+        for car, car_rays in enumerate(rays):
+            if not cars.alive[car]:
+                continue
+            origin = tuple(cars.position[car])
+            for ray, angle, distance in zip(car_rays, ray_angles - cars.facing_angle[car],
+                                            fields["rays"][tick, shown[car]].tolist()):
+                ray.set_cast(origin, angle, distance)
+                ray.display()
+        window.blit(default_font.render(f"Update {tick}/{max(length - 1, 0)}", True, (255, 255, 255)),
+                    (10, window.get_height() - 25))
+        pg.display.update()
+
+        clock.tick(TICKS_PER_SECOND * speed)
+        if not paused and tick < length - 1:
+            tick += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays back recorded generations.")
+    parser.add_argument("recording", nargs="?", type=Path,
+                        help="A recording, or a generation's folder of them (the newest generation if none is given).")
+    parser.add_argument("--track", type=int, default=0,
+                        help="Which track to play, when a generation was run on more than one (see MULTI_TRACK).")
+    parser.add_argument("--genomes", type=int, nargs="+", metavar="ID", help="Only show these genomes.")
+    parser.add_argument("--top", type=int, default=0, help="Only show this many of the cars with the highest fitness.")
+    parser.add_argument("--speed", type=float, default=1, help="How many times faster than normal to play it.")
+    args = parser.parse_args()
+
+    path = args.recording
+    if path is None:
+        generations = sorted(Path(TRAINING_CONFIG["RECORDING_DIR"]).glob("generation-*"))
+        if not generations:
+            parser.error(f"There are no recordings in {TRAINING_CONFIG['RECORDING_DIR']}")
+        path = generations[-1]
+    if path.is_dir():
+        paths = sorted(path.glob(f"track{args.track}.rec")) + sorted(path.glob(f"track{args.track}-share*.rec"))
+        if not paths:
+            parser.error(f"There are no recordings of track {args.track} in {path}")
+    else:
+        paths = [path]
+
+    replay(paths, args.genomes, args.top, args.speed)
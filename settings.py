@@ -0,0 +1,294 @@
+# Loads config.txt once, checks every value in it, and turns it into a read-only object that
+# everything else gets its settings from, like CONFIG.CAR.CONTROL.MAX_SPEED (or
+# CONFIG["CAR"]["CONTROL"]["MAX_SPEED"], both work).
+#
+# The checked result gets saved in __pycache__, named after a hash of config.txt (and the schema
+# below), so config.txt only actually has to be parsed again after it changes. Worker processes get
+# handed the training process's config instead of loading their own (see load_config).
+
+import os
+import pickle
+from ast import literal_eval
+from hashlib import sha1
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+# I know there's an official python library for this (configparser), but configobj has more options and supports things like nested config sections.
+from configobj import ConfigObj
+
+class ConfigError(Exception):
+    pass
+
+
+# Checks for each kind of value, and how they get described in error messages
+def is_number(value:Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_integer(value:Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def is_boolean(value:Any) -> bool:
+    return isinstance(value, bool)
+
+def is_color(value:Any) -> bool:
+    return isinstance(value, tuple) and len(value) == 3 and all(is_integer(i) and 0 <= i <= 255 for i in value)
+
+def is_text(value:Any) -> bool:
+    return isinstance(value, str)
+
+def is_optional_text(value:Any) -> bool:
+    return value is None or isinstance(value, str)
+
+def is_optional_indices(value:Any) -> bool:
+    return value is None or (isinstance(value, tuple) and len(value) > 0 and all(is_integer(i) and i >= 0 for i in value))
+
+# For settings that can only be one of a few strings
+def one_of(*options:str) -> Tuple:
+    def is_option(value:Any) -> bool:
+        return value in options
+    return (is_option, " or ".join(repr(i) for i in options))
+
+NUMBER = (is_number, "a number")
+INTEGER = (is_integer, "a whole number")
+BOOLEAN = (is_boolean, "True or False")
+COLOR = (is_color, "a color like \"(255, 0, 0)\"")
+TEXT = (is_text, "a quoted string like \"'text'\"")
+OPTIONAL_TEXT = (is_optional_text, "a quoted string like \"'text'\" or None")
+OPTIONAL_INDICES = (is_optional_indices, "a list of whole numbers like \"(0, 2)\" (or \"(1,)\" for just one), or None")
+
+# Every setting that has to be in config.txt, and what kind of value it has to be. Anything that
+# isn't in here (or is missing from config.txt) is an error.
+SCHEMA = {
+    "CAR": {
+        "CONTROL": {
+            "MAX_SPEED": NUMBER,
+            "TURN_SPEED_MULT": NUMBER,
+            "SPEED_START_DELTA": NUMBER,
+            "SPEED_END_DELTA": NUMBER,
+            "ACCELERATION": NUMBER,
+            "BRAKING_FORCE": NUMBER,
+            "FRICTION": NUMBER,
+        },
+        "STEERING": {
+            "STEERING_RESPONSE": NUMBER,
+            "TURN_STEERING_MULT": NUMBER,
+            "STEERING_START_DELTA": NUMBER,
+            "STEERING_END_DELTA": NUMBER,
+        },
+        "PHYSICS": {
+            "SNAP_THRESHOLD": NUMBER,
+            "MAX_DELTA": NUMBER,
+            "NO_OVERSHOOT": BOOLEAN,
+            "MIN_GRIP": NUMBER,
+            "MAX_GRIP": NUMBER,
+            "POINT_SCALAR": NUMBER,
+            "GRIP_EXP": NUMBER,
+        },
+        "DISPLAY": {
+            "WIDTH": NUMBER,
+            "LENGTH": NUMBER,
+            "BODY_COLOR": COLOR,
+            "SPRITE_ANGLES": INTEGER,
+        },
+        "DEBUG": {
+            "VECTOR_DEBUG": BOOLEAN,
+            "VELOCITY_COLOR": COLOR,
+            "FACING_COLOR": COLOR,
+            "LINE_WIDTH": INTEGER,
+            "DEBUG_TEXT": BOOLEAN,
+        },
+    },
+    "AI_TRAINING": {
+        "MIN_MOVE_AMOUNT": NUMBER,
+        "MAX_TICKS": INTEGER,
+        "LAPS_TO_COMPLETE": INTEGER,
+        "NO_PROGRESS_TIMEOUT": INTEGER,
+        "SPAWN_VELOCITY": NUMBER,
+        "CHANGE_TRACKS": BOOLEAN,
+        "GENERATIONS_PER_TRACK": INTEGER,
+        "TRACK_TAG": OPTIONAL_TEXT,
+        "MULTI_TRACK": BOOLEAN,
+        "EVALUATION_TRACKS": OPTIONAL_INDICES,
+        "TRACK_FITNESS": one_of("mean", "min"),
+        "NUM_GENERATIONS": INTEGER,
+        "DEATH_PENALTY": NUMBER,
+        "CHECKPOINT_SCORE": NUMBER,
+        "CHECKPOINT_ADVANCE_SCORE": NUMBER,
+        "MAX_TIME_MULTIPLIER": NUMBER,
+        "TIME_MULTIPLIER_DECAY": NUMBER,
+        "STEERING_SNAP": NUMBER,
+        "THROTTLE_SNAP": NUMBER,
+        "ALLOW_BRAKING": BOOLEAN,
+        "WORKERS": INTEGER,
+        "DISTRIBUTED": BOOLEAN,
+        "DISTRIBUTED_HOST": TEXT,
+        "DISTRIBUTED_PORT": INTEGER,
+        "DISTRIBUTED_KEY": TEXT,
+        "DISTRIBUTED_TIMEOUT": NUMBER,
+        "FITNESS_CACHE_SIZE": INTEGER,
+        "PROFILE_EVERY": INTEGER,
+        "RECORD_TRAJECTORIES": BOOLEAN,
+        "RECORDING_DIR": TEXT,
+        "RECORDINGS_KEPT": INTEGER,
+        "CHECKPOINT_EVERY": INTEGER,
+        "CHECKPOINT_DIR": TEXT,
+        "CHECKPOINTS_KEPT": INTEGER,
+    },
+    "RAYCASTING": {
+        "CAST_LENGTH": NUMBER,
+        "TRUNCATE_RAY": BOOLEAN,
+        "RAY_COLOR": COLOR,
+        "RAY_WIDTH": INTEGER,
+        "SHOW_INTERSECTION": BOOLEAN,
+        "INTERSECT_RADIUS": NUMBER,
+        "INTERSECT_COLOR": COLOR,
+        "SHOW_DISTANCE": BOOLEAN,
+        "DISTANCE_DECIMALS": INTEGER,
+    },
+    "TRACKS": {
+        "TRACKS_FILE": TEXT,
+        "LOADED_TRACKS": INTEGER,
+        "LINE_WIDTH": INTEGER,
+        "SHOW_CHECKPOINTS": BOOLEAN,
+        "SHOW_COLLISIONS": BOOLEAN,
+        "BORDER_COLOR": COLOR,
+        "BORDER_COLLIDE_COLOR": COLOR,
+        "CHECKPOINT_COLOR": COLOR,
+        "CHECKPOINT_COLLIDE_COLOR": COLOR,
+        "FINISH_LINE_COLOR": COLOR,
+        "FINISH_LINE_COLLIDE_COLOR": COLOR,
+        "GRID_CELL_SIZE": NUMBER,
+        "GRID_MIN_SEGMENTS": INTEGER,
+        "DISTANCE_FIELD": BOOLEAN,
+        "DISTANCE_FIELD_RESOLUTION": NUMBER,
+        "DISTANCE_FIELD_STEPS": INTEGER,
+        "DISTANCE_FIELD_CACHE": OPTIONAL_TEXT,
+    },
+    "GAME": {
+        "HEADLESS": BOOLEAN,
+        "SHOW_RAYS": BOOLEAN,
+        "RENDER_EVERY": INTEGER,
+        "DRAW_TOP_CARS": INTEGER,
+        "BACKGROUND_COLOR": COLOR,
+        "TEXT_COLOR": COLOR,
+    },
+}
+
+
+# A read-only section of the config. Settings can be read as attributes or like a dictionary.
+class ConfigSection:
+    def __init__(self, name:str, values:Dict[str, Any]) -> None:
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_values", values)
+
+    def __getattr__(self, key:str) -> Any:
+        # Anything starting with an underscore is internal (this also keeps pickle from
+        # getting stuck looking for _values before it's been set)
+        if key.startswith("_"):
+            raise AttributeError(key)
+        try:
+            return self._values[key]
+        except KeyError:
+            raise AttributeError(f"{self._name} has no setting called {key}") from None
+
+    def __getitem__(self, key:str) -> Any:
+        return self._values[key]
+
+    def __setattr__(self, key:str, value:Any) -> None:
+        raise AttributeError("The config can't be changed once it's loaded")
+
+    def __delattr__(self, key:str) -> None:
+        raise AttributeError("The config can't be changed once it's loaded")
+
+    def __contains__(self, key:str) -> bool:
+        return key in self._values
+
+    def keys(self) -> List[str]:
+        return list(self._values.keys())
+
+    def items(self) -> List:
+        return list(self._values.items())
+
+    def __repr__(self) -> str:
+        return f"ConfigSection({self._name}, {self._values!r})"
+
+
+# Checks one section of the config against its schema, and adds anything wrong with it to errors
+def compile_section(name:str, raw:Dict, schema:Dict, errors:List[str]) -> ConfigSection:
+    values = {}
+    for key in raw:
+        if key not in schema:
+            errors.append(f"{name}: unknown setting {key}")
+    for key, expected in schema.items():
+        path = f"{name}.{key}" if name else key
+        if key not in raw:
+            errors.append(f"{path} is missing")
+        elif isinstance(expected, dict):
+            if not isinstance(raw[key], dict):
+                errors.append(f"{path} should be a section, not a setting")
+            else:
+                values[key] = compile_section(path, raw[key], expected, errors)
+        else:
+            check, description = expected
+            try:
+                value = literal_eval(raw[key])
+            except (ValueError, SyntaxError):
+                errors.append(f"{path} = {raw[key]!r} can't be read (strings need quotes inside the quotes)")
+                continue
+            if not check(value):
+                errors.append(f"{path} should be {description}, not {value!r}")
+            values[key] = value
+    return ConfigSection(name or "config", values)
+
+# Parses and checks a config file. Raises a ConfigError listing every problem with it, if there are any.
+def compile_config(path:Path) -> ConfigSection:
+    errors = []
+    config = compile_section("", ConfigObj(str(path)), SCHEMA, errors)
+    if errors:
+        raise ConfigError(f"Problems in {path}:\n    " + "\n    ".join(errors))
+    return config
+
+
+# A description of the schema that's the same every time the program runs (the check functions
+# can't be used directly, since how they get printed includes where they are in memory)
+def schema_description(schema:Dict) -> Dict:
+    return {key: schema_description(expected) if isinstance(expected, dict) else (expected[0].__name__, expected[1])
+            for key, expected in schema.items()}
+
+
+# The config that's already been loaded, so it only gets loaded once per process
+loaded_config = None
+
+# Returns the config, loading it if it hasn't been loaded yet. The checked config gets saved, so
+# next time it can just be loaded from that (as long as neither config.txt nor the schema changed).
+# If a config is given (like one handed to a worker process), it gets used from then on instead.
+# Most of the simulation code reads the config as soon as it's imported and keeps what it got, so
+# a config has to be handed in before any of that gets imported.
+def load_config(path:Path=Path("config.txt"), config:ConfigSection=None) -> ConfigSection:
+    global loaded_config
+    if config is not None:
+        loaded_config = config
+    if loaded_config is not None:
+        return loaded_config
+
+    path = Path(path)
+    key = sha1(path.read_bytes())
+    key.update(repr(schema_description(SCHEMA)).encode())
+    cache_file = path.parent / "__pycache__" / f"{path.stem}.{key.hexdigest()}.pickle"
+    try:
+        with open(cache_file, "rb") as f:
+            loaded_config = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        loaded_config = compile_config(path)
+        try:
+            os.makedirs(cache_file.parent, exist_ok=True)
+            temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(temp_file, "wb") as f:
+                pickle.dump(loaded_config, f)
+            os.replace(temp_file, cache_file)
+            # Older versions of the config are never going to be used again
+            for old_file in cache_file.parent.glob(f"{path.stem}.*.pickle"):
+                if old_file != cache_file:
+                    old_file.unlink(missing_ok=True)
+        except OSError:
+            pass  # Not being able to save it just means it gets parsed again next time
+    return loaded_config
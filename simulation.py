@@ -0,0 +1,282 @@
+from car import *
+from track import *
+from raycast import *
+from utils import *
+from batchnet import BatchNetwork
+from profiler import PhaseProfiler
+import neat
+import numpy as np
+from typing import List, Tuple
+
+from settings import load_config
+TRAINING_CONFIG = load_config().AI_TRAINING
+
+# The simulation always moves forward in fixed steps, no matter how fast it's actually
+# being run. The windowed mode runs one step every 20 milliseconds (50 per second), and
+# headless mode just runs them back-to-back as fast as the computer can handle.
+TICKS_PER_SECOND = 50
+TIME_MULTIPLIER_DECAY = TRAINING_CONFIG["TIME_MULTIPLIER_DECAY"] / TICKS_PER_SECOND
+
+ray_angles = (-90, -45, 0, 45, 90)
+ray_angle_array = np.array(ray_angles, dtype=float)
+
+
+# Combines each genome's fitness from several tracks (one row per track) into a single value,
+# either the average ("mean") or its worst track ("min")
+def combine_fitness(fitness:np.ndarray, method:str) -> np.ndarray:
+    if method == "min":
+        return fitness.min(axis=0)
+    return fitness.mean(axis=0)
+
+
+# Runs one generation of AI training on a single track. None of this needs a window, so
+# the surface and fonts are only required if the cars and rays are actually displayed.
+# Raycasting is done for every car at once with batch_cast, so Ray objects are only
+# created (and kept up to date) if show_rays is True.
+# All the cars are stored in a single CarBatch, so everything about car i (its network,
+# genome, rays, etc.) is at index i of the lists below. Dead cars are never removed, they're
+# just marked as not alive.
+class Simulation:
+    def __init__(self, track:Track, genomes:List, config:neat.Config, surface:"pg.surface.Surface"=None,
+                car_font:"pg.font.Font"=None, ray_font:"pg.font.Font"=None, show_rays:bool=False,
+                profiler:PhaseProfiler=None, recorder:"TrajectoryRecorder"=None) -> None:
+        self.track = track
+        # Records how long each part of an update takes (does nothing if one isn't given)
+        self.profiler = profiler if profiler is not None else PhaseProfiler(0)
+        # Records what every car does on each update, so it can be played back (see recording.py)
+        self.recorder = recorder
+        self.nets = [neat.nn.FeedForwardNetwork.create(g, config) for _, g in genomes]
+        self.batch_net = BatchNetwork(self.nets)
+        self.ge = [g for _, g in genomes]
+        self.cars = CarBatch(surface, car_font, len(genomes), track.start_point,
+                             track.start_angle, TRAINING_CONFIG["SPAWN_VELOCITY"])
+        self.fitness = np.zeros(len(genomes))
+        self.car_multipliers = np.full(len(genomes), float(TRAINING_CONFIG["MAX_TIME_MULTIPLIER"]))
+        self.show_rays = show_rays
+        self.running = True
+        # Number of updates where the cars actually moved, and whether the generation
+        # ended because a car stopped moving.
+        self.ticks = 0
+        self.stalled = False
+        # The update each car died (or finished every lap) on, or -1 if it's still going. Cars that
+        # stopped moving die at the start of an update, and everything else happens at the end of one.
+        self.death_ticks = np.full(len(genomes), -1)
+        # Cars that start partway through the generation (see resume_car), grouped by the update
+        # they start on
+        self.resuming = {}
+
+        # Which checkpoints each car has already passed (one row per car, one column per
+        # checkpoint), and how many that is.
+        self.passed_checkpoints = np.zeros((len(genomes), len(track.checkpoints)), dtype=bool)
+        self.passed_count = np.zeros(len(genomes), dtype=int)
+        # How many laps each car has finished, and how many updates it's been since each car last
+        # reached a new checkpoint
+        self.laps = np.zeros(len(genomes), dtype=int)
+        self.since_progress = np.zeros(len(genomes), dtype=int)
+
+        # Where each car is on the track's centerline, and the distance and angle to the next
+        # checkpoint ahead of it. The distance is the closest the car has gotten so far.
+        self.centerline_segments, self.last_cp_distance, self.last_cp_angle =\
+            track.next_checkpoints(self.cars.position, self.cars.facing_angle)
+
+        self.car_rays = []
+        if show_rays:
+            self.car_rays = [[Ray(surface, ray_font, track.start_point, -track.start_angle + i)
+                              for i in ray_angles] for _ in genomes]
+
+        for g in self.ge:
+            g.fitness = 0
+
+    # Returns everything about car i that changes during the generation, so it can pick up from
+    # this point again later with resume_car
+    def car_state(self, i:int) -> Tuple:
+        cars = self.cars
+        return (cars.position[i].copy(), cars.speed[i], cars.facing_angle[i], cars.velocity_angle[i],
+                cars.angle_delta[i], cars.distance_since_last[i], self.fitness[i], self.car_multipliers[i],
+                self.passed_checkpoints[i].copy(), self.passed_count[i], self.laps[i], self.since_progress[i],
+                self.centerline_segments[i], self.last_cp_distance[i], self.last_cp_angle[i])
+
+    # Makes car i sit out the generation until update "tick", and then carry on from a state saved
+    # by car_state at that update. Its fitness before then is whatever it was in the saved run.
+    def resume_car(self, i:int, tick:int, state:Tuple) -> None:
+        self.cars.alive[i] = False
+        self.resuming.setdefault(tick, []).append((i, state))
+
+    def __restore(self, i:int, state:Tuple) -> None:
+        cars = self.cars
+        (cars.position[i], cars.speed[i], cars.facing_angle[i], cars.velocity_angle[i], cars.angle_delta[i],
+         cars.distance_since_last[i], self.fitness[i], self.car_multipliers[i], self.passed_checkpoints[i],
+         self.passed_count[i], self.laps[i], self.since_progress[i], self.centerline_segments[i],
+         self.last_cp_distance[i], self.last_cp_angle[i]) = state
+        cars.alive[i] = True
+
+    # Kills every car in the mask
+    def __kill(self, mask:np.ndarray) -> None:
+        self.fitness[mask] -= TRAINING_CONFIG["DEATH_PENALTY"]
+        self.cars.alive &= ~mask
+
+    # Ends the generation and gives each genome its final fitness
+    def __finish(self) -> None:
+        self.running = False
+        for g, fitness in zip(self.ge, self.fitness.tolist()):
+            g.fitness = fitness
+
+    # Advances every car by one step. Returns False once the generation is over.
+    def tick(self) -> bool:
+        track = self.track
+        cars = self.cars
+        for i, state in self.resuming.pop(self.ticks, []):
+            self.__restore(i, state)
+
+        # Out of time. Every car that's still going keeps the fitness it has now.
+        if self.ticks == TRAINING_CONFIG["MAX_TICKS"] and self.ticks > 0:
+            self.__finish()
+            return self.running
+
+        # Kill the AIs whose cars haven't moved far enough since the last update.
+        # This also ends the generation for everyone else.
+        stalled = cars.alive & (cars.distance_since_last < TRAINING_CONFIG["MIN_MOVE_AMOUNT"])
+        if stalled.any():
+            self.__kill(stalled)
+            self.death_ticks[stalled] = self.ticks
+            self.stalled = True
+            self.__finish()
+            return self.running
+
+        alive = np.flatnonzero(cars.alive)
+        # Nothing to do until the next car resumes
+        if len(alive) == 0:
+            if self.recorder is not None:
+                self.recorder.record(cars, alive, None, None, None)
+            self.ticks += 1
+            return self.running
+
+        profiler = self.profiler
+        profiler.begin("tick")
+
+        # Calculate distances from raycasts for every car at once
+        origins = cars.position[alive]
+        angles = ray_angle_array - cars.facing_angle[alive, np.newaxis]
+        distances = batch_cast(origins, angles, track.border_segments, track.raycast_grid)
+        if self.show_rays:
+            for i, origin, car_angles, car_distances in zip(alive, origins, angles, distances):
+                for ray, angle, distance in zip(self.car_rays[i], car_angles, car_distances):
+                    ray.set_cast(tuple(origin), angle, distance)
+        profiler.lap("raycasts")
+
+        # Get control inputs from every AI at once
+        inputs = np.column_stack((distances, cars.speed[alive], cars.angle_delta[alive], self.last_cp_angle[alive]))
+        outputs = self.batch_net.activate(inputs, alive)
+
+        steering_input = np.zeros(cars.count)
+        steering_input[alive] = np.where(outputs[:, 0] > TRAINING_CONFIG["STEERING_SNAP"], 1,
+                                         np.where(outputs[:, 0] < -TRAINING_CONFIG["STEERING_SNAP"], -1, 0))
+        throttle = np.zeros(cars.count)
+        throttle[alive] = np.where(outputs[:, 1] > TRAINING_CONFIG["THROTTLE_SNAP"], 1,
+                                   np.where((outputs[:, 1] < -TRAINING_CONFIG["THROTTLE_SNAP"])
+                                            & TRAINING_CONFIG["ALLOW_BRAKING"], -1, 0))
+        profiler.lap("networks")
+        if self.recorder is not None:
+            self.recorder.record(cars, alive, steering_input, throttle, distances)
+            profiler.lap("recording")
+
+        # Move every car, then calculate any collisions or checkpoint passes
+        old_positions = cars.position[alive]
+        cars.move(throttle, steering_input)
+        profiler.lap("physics")
+        hit_border, crossed = track.batch_collide(cars.hitboxes()[alive], old_positions, cars.position[alive])
+
+        # Kill the AIs whose cars hit the track walls
+        crashed = np.zeros(cars.count, dtype=bool)
+        crashed[alive[hit_border]] = True
+        profiler.lap("collisions")
+
+        # Count how many checkpoints each car passed for the first time (almost always none)
+        finish_line = len(track.checkpoints)
+        new_checkpoints = np.zeros(len(alive), dtype=int)
+        for row in np.flatnonzero((crossed.max(axis=1, initial=-1) >= 0) & ~hit_border):
+            i = alive[row]
+            car_crossed = np.unique(crossed[row][crossed[row] >= 0])
+            for cp in car_crossed[car_crossed < finish_line]:
+                if not self.passed_checkpoints[i, cp]:
+                    self.passed_checkpoints[i, cp] = True
+                    self.passed_count[i] += 1
+                    new_checkpoints[row] += 1
+
+            # Reset the car's passed checkpoints if it completes a lap. This *should*
+            # ensure every checkpoint has been passed before starting a new lap.
+            if car_crossed[-1] == finish_line and self.passed_count[i] == finish_line:
+                self.passed_checkpoints[i] = False
+                self.passed_count[i] = 0
+                self.laps[i] += 1
+                new_checkpoints[row] += 1  # The finish line is *technically* a checkpoint too
+
+        # Find the next checkpoint ahead of every car
+        last_segments = self.centerline_segments[alive]
+        segments, cp_distance, cp_angle = track.next_checkpoints(
+            cars.position[alive], cars.facing_angle[alive], last_segments)
+        self.centerline_segments[alive] = segments
+        profiler.lap("checkpoints")
+
+        # Assign fitness values (the cars that crashed are killed below, so they get skipped)
+        scoring = ~hit_border
+        cars_scoring = alive[scoring]
+        passed = new_checkpoints[scoring] > 0
+        cp_distance = cp_distance[scoring]
+        last_distance = self.last_cp_distance[cars_scoring]
+        # The next checkpoint comes from the centerline, which doesn't always move on to the next
+        # one on exactly the same update the car crosses a checkpoint. So the distance gets reset
+        # whenever the next checkpoint changes, instead of whenever a checkpoint is passed.
+        new_target = (segments != last_segments)[scoring]
+
+        # If a car has passed a checkpoint, increase its fitness based on the time
+        # multiplier, then reset the time multiplier. Otherwise, decrease the time
+        # multiplier to a minimum of 1.
+        multipliers = self.car_multipliers[cars_scoring]
+        self.fitness[cars_scoring] += TRAINING_CONFIG["CHECKPOINT_SCORE"] * multipliers * new_checkpoints[scoring]
+        self.car_multipliers[cars_scoring] = np.where(passed, TRAINING_CONFIG["MAX_TIME_MULTIPLIER"],
+            np.maximum(multipliers - TIME_MULTIPLIER_DECAY, 1))
+
+        # Alter the AIs' fitness based on their distance to the next checkpoint, and reset
+        # the distance for the ones heading to a different checkpoint now.
+        closer = ~new_target & (cp_distance < last_distance)
+        self.fitness[cars_scoring[closer]] += (last_distance[closer] - cp_distance[closer])\
+                                              * TRAINING_CONFIG["CHECKPOINT_ADVANCE_SCORE"]
+        self.last_cp_distance[cars_scoring] = np.where(new_target, cp_distance, np.minimum(last_distance, cp_distance))
+        self.last_cp_angle[cars_scoring] = cp_angle[scoring]
+
+        # Cars that haven't reached a new checkpoint in too long are killed, same as if they crashed.
+        # This catches cars that keep moving without getting anywhere, like ones driving in circles.
+        self.since_progress[cars_scoring] = np.where(passed, 0, self.since_progress[cars_scoring] + 1)
+        if TRAINING_CONFIG["NO_PROGRESS_TIMEOUT"] > 0:
+            crashed[cars_scoring] |= self.since_progress[cars_scoring] >= TRAINING_CONFIG["NO_PROGRESS_TIMEOUT"]
+
+        # Cars that finished every lap stop where they are and keep their fitness (the time
+        # multiplier means the faster they did it, the higher it is)
+        finished = np.zeros(cars.count, dtype=bool)
+        if TRAINING_CONFIG["LAPS_TO_COMPLETE"] > 0:
+            finished[cars_scoring] = self.laps[cars_scoring] >= TRAINING_CONFIG["LAPS_TO_COMPLETE"]
+        finished &= ~crashed
+        cars.alive &= ~finished
+
+        self.__kill(crashed)
+        self.death_ticks[crashed | finished] = self.ticks
+        self.ticks += 1
+        profiler.lap("fitness")
+
+        if not cars.alive.any() and not self.resuming:
+            self.__finish()
+
+        return self.running
+
+    # Returns the cars that are still alive, sorted from highest to lowest fitness. If a count is
+    # given (and isn't 0), only that many of them are returned.
+    def leaders(self, count:int=0) -> np.ndarray:
+        alive = np.flatnonzero(self.cars.alive)
+        leaders = alive[np.argsort(-self.fitness[alive], kind="stable")]
+        return leaders[:count] if count > 0 else leaders
+
+    # Headless mode: runs the whole generation in a tight loop, without waiting on a timer.
+    def run(self) -> None:
+        while self.running:
+            self.tick()
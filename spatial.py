@@ -0,0 +1,226 @@
+# Spatial indexing for line segments, so that raycasts and collision checks only have
+# to look at the parts of the track that are actually near them instead of every segment.
+# Everything in here works on whole arrays of rays/boxes at once, same as batch_cast.
+
+from typing import Dict
+import numpy as np
+
+# Returns how far along each ray it hits each segment, or infinity if it doesn't hit it (or hits
+# it further away than max_distance). The origin and direction arrays (directions have to be
+# unit vectors) get broadcast against the (..., 4) segment array, so any shapes that broadcast
+# together work. Rays that are parallel to a segment never count as hitting it.
+def ray_segment_distances(origin_x:np.ndarray, origin_y:np.ndarray, dir_x:np.ndarray, dir_y:np.ndarray,
+                        segments:np.ndarray, max_distance:float) -> np.ndarray:
+    seg_x = segments[..., 0]
+    seg_y = segments[..., 1]
+    edge_x = segments[..., 2] - seg_x
+    edge_y = segments[..., 3] - seg_y
+
+    # Vector from each origin to the start of each segment
+    to_seg_x = seg_x - origin_x
+    to_seg_y = seg_y - origin_y
+
+    # Standard line-line intersection: "distance" is how far along the ray the intersection
+    # is, and "along" is how far along the segment it is (0 is the start, 1 is the end).
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denominator = dir_x * edge_y - dir_y * edge_x
+        distance = (to_seg_x * edge_y - to_seg_y * edge_x) / denominator
+        along = (to_seg_x * dir_y - to_seg_y * dir_x) / denominator
+
+    hit = (denominator != 0) & (along >= 0) & (along <= 1) & (distance > 0) & (distance < max_distance)
+    return np.where(hit, distance, np.inf)
+
+# Returns whether each segment touches each axis-aligned box (including just touching the
+# edges). Boxes are (x_min, y_min, x_max, y_max), and get broadcast against the segments.
+def segments_hit_boxes(segments:np.ndarray, boxes:np.ndarray) -> np.ndarray:
+    # Liang-Barsky clipping: clip each segment to the box and see if anything is left.
+    start_x = segments[..., 0]
+    start_y = segments[..., 1]
+    dx = segments[..., 2] - start_x
+    dy = segments[..., 3] - start_y
+    p = np.stack(np.broadcast_arrays(-dx, dx, -dy, dy))
+    q = np.stack(np.broadcast_arrays(start_x - boxes[..., 0], boxes[..., 2] - start_x,
+                                     start_y - boxes[..., 1], boxes[..., 3] - start_y))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = q / p
+    enter = np.maximum(np.where(p < 0, ratio, -np.inf).max(axis=0), 0)
+    leave = np.minimum(np.where(p > 0, ratio, np.inf).min(axis=0), 1)
+    # Segments parallel to an edge of the box that are on the wrong side of it can't hit the box
+    parallel_outside = ((p == 0) & (q < 0)).any(axis=0)
+    return (enter <= leave) & ~parallel_outside
+
+# Returns whether each segment in a crosses (or touches) each segment in b. Both are (..., 4)
+# arrays that get broadcast together. Parallel segments never count as crossing.
+def segments_cross(a:np.ndarray, b:np.ndarray) -> np.ndarray:
+    a_x = a[..., 2] - a[..., 0]
+    a_y = a[..., 3] - a[..., 1]
+    b_x = b[..., 2] - b[..., 0]
+    b_y = b[..., 3] - b[..., 1]
+    start_x = b[..., 0] - a[..., 0]
+    start_y = b[..., 1] - a[..., 1]
+
+    # Same idea as ray_segment_distances, except both intersection points have to be between 0 and 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denominator = a_x * b_y - a_y * b_x
+        along_a = (start_x * b_y - start_y * b_x) / denominator
+        along_b = (start_x * a_y - start_y * a_x) / denominator
+    return (denominator != 0) & (along_a >= 0) & (along_a <= 1) & (along_b >= 0) & (along_b <= 1)
+
+
+# A uniform grid laid over a set of line segments. Each cell stores every segment whose bounding
+# box overlaps it, so a query only has to test the segments in the cells it touches. Built once
+# per track, since the segments never move.
+class SegmentGrid:
+    def __init__(self, segments:np.ndarray, cell_size:float) -> None:
+        self.segments = np.asarray(segments, dtype=float)
+        self.cell_size = cell_size
+
+        xs = self.segments[:, (0, 2)]
+        ys = self.segments[:, (1, 3)]
+        self.min_corner = np.array((xs.min(), ys.min()))
+        self.max_corner = np.array((xs.max(), ys.max()))
+        self.shape = (np.floor((self.max_corner - self.min_corner) / cell_size).astype(int) + 1)
+        self.max_corner = self.min_corner + self.shape * cell_size
+        width, height = self.shape
+
+        # Segments are padded by a tiny bit so ones that lie exactly on a cell edge get added
+        # to the cells on both sides of it.
+        padding = cell_size * 1e-6
+        low_cells = self.__cell_of(np.column_stack((xs.min(axis=1), ys.min(axis=1))) - padding)
+        high_cells = self.__cell_of(np.column_stack((xs.max(axis=1), ys.max(axis=1))) + padding)
+
+        # The extra cell at the end is always empty, and is used to pad out queries.
+        cell_lists = [[] for _ in range(width * height + 1)]
+        for i, (low, high) in enumerate(zip(low_cells, high_cells)):
+            for cell_y in range(low[1], high[1] + 1):
+                for cell_x in range(low[0], high[0] + 1):
+                    cell_lists[cell_y * width + cell_x].append(i)
+        self.empty_cell = width * height
+
+        # Stored the same way as a sparse matrix: the segments in cell i are
+        # cell_segments[cell_start[i]:cell_start[i + 1]]
+        self.cell_start = np.cumsum([0] + [len(i) for i in cell_lists])
+        self.cell_segments = np.array([i for cell in cell_lists for i in cell] + [-1], dtype=int)
+
+    # Everything the grid is made of, as plain arrays (for saving it as part of a compiled track)
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "segments": self.segments,
+            "cell_size": np.array(self.cell_size, dtype=float),
+            "min_corner": self.min_corner,
+            "max_corner": self.max_corner,
+            "shape": self.shape,
+            "cell_start": self.cell_start,
+            "cell_segments": self.cell_segments,
+        }
+
+    # Rebuilds a grid from the arrays to_arrays returned, without redoing any of the work
+    @classmethod
+    def from_arrays(cls, arrays:Dict[str, np.ndarray]) -> "SegmentGrid":
+        grid = cls.__new__(cls)
+        grid.segments = arrays["segments"]
+        grid.cell_size = float(arrays["cell_size"])
+        grid.min_corner = arrays["min_corner"]
+        grid.max_corner = arrays["max_corner"]
+        grid.shape = arrays["shape"]
+        grid.cell_start = arrays["cell_start"]
+        grid.cell_segments = arrays["cell_segments"]
+        grid.empty_cell = int(grid.shape[0] * grid.shape[1])
+        return grid
+
+    # Returns the (x, y) cell each point is in. Points outside the grid get the closest cell.
+    def __cell_of(self, points:np.ndarray) -> np.ndarray:
+        cells = np.floor((points - self.min_corner) / self.cell_size).astype(int)
+        return np.clip(cells, 0, self.shape - 1)
+
+    # Returns the segments in each cell as an (N, K) array, where K is the most segments in
+    # any of the cells. Rows with less than K segments are padded with -1.
+    def __gather(self, cells:np.ndarray) -> np.ndarray:
+        start = self.cell_start[cells]
+        count = self.cell_start[cells + 1] - start
+        offsets = np.arange(count.max(initial=0))
+        valid = offsets < count[..., np.newaxis]
+        # The last entry of cell_segments is -1, so that's where the padding comes from.
+        return self.cell_segments[np.where(valid, start[..., np.newaxis] + offsets, -1)]
+
+    # Same as batch_cast, except the origins, directions (unit vectors) and results are flat
+    # arrays with one entry per ray. Rays step through the grid one cell at a time (all of
+    # them at once) and stop at the first cell where they hit something.
+    def cast(self, origins:np.ndarray, directions:np.ndarray, max_distance:float) -> np.ndarray:
+        closest = np.full(len(origins), np.inf)
+
+        # Find where each ray enters the grid, in case it starts outside of it
+        with np.errstate(divide="ignore", invalid="ignore"):
+            to_min = (self.min_corner - origins) / directions
+            to_max = (self.max_corner - origins) / directions
+        inside = (origins >= self.min_corner) & (origins <= self.max_corner)
+        near = np.where(directions == 0, np.where(inside, -np.inf, np.inf), np.minimum(to_min, to_max))
+        far = np.where(directions == 0, np.where(inside, np.inf, -np.inf), np.maximum(to_min, to_max))
+        enter = np.maximum(near.max(axis=1), 0)
+        active = (enter <= far.min(axis=1)) & (enter < max_distance)
+
+        # Standard grid traversal: "next_edge" is how far along the ray it crosses into the next
+        # cell on each axis, and "edge_spacing" is how far apart those crossings are.
+        cells = self.__cell_of(origins + directions * enter[:, np.newaxis])
+        step = np.where(directions > 0, 1, -1)
+        edges = self.min_corner + (cells + (step > 0)) * self.cell_size
+        with np.errstate(divide="ignore", invalid="ignore"):
+            next_edge = np.where(directions != 0, (edges - origins) / directions, np.inf)
+            edge_spacing = np.where(directions != 0, self.cell_size / np.abs(directions), np.inf)
+
+        while active.any():
+            rays = np.flatnonzero(active)
+            segment_ids = self.__gather(cells[rays, 1] * self.shape[0] + cells[rays, 0])
+            distances = ray_segment_distances(origins[rays, 0, np.newaxis], origins[rays, 1, np.newaxis],
+                                              directions[rays, 0, np.newaxis], directions[rays, 1, np.newaxis],
+                                              self.segments[segment_ids], max_distance)
+
+            # Only hits inside the current cell count, since a segment in a later cell might be closer.
+            # (A small tolerance is fine here, the hit would be found in the next cell anyway.)
+            leave = next_edge[rays].min(axis=1)
+            distances[(segment_ids < 0) | (distances > leave[:, np.newaxis] + 1e-7)] = np.inf
+            best = distances.min(axis=1, initial=np.inf)
+            found = best < np.inf
+            closest[rays[found]] = best[found]
+
+            # Move each ray into the next cell along whichever axis it reaches first
+            axis = np.argmin(next_edge[rays], axis=1)
+            cells[rays, axis] += step[rays, axis]
+            next_edge[rays, axis] += edge_spacing[rays, axis]
+            left_grid = ((cells[rays] < 0) | (cells[rays] >= self.shape)).any(axis=1)
+            active[rays[found | left_grid | (leave >= max_distance)]] = False
+
+        return closest
+
+    # Returns every segment in the cells each box overlaps as an (N, K) array of segment indices,
+    # padded with -1. Boxes are (x_min, y_min, x_max, y_max). A segment can show up more than once.
+    def __box_candidates(self, boxes:np.ndarray) -> np.ndarray:
+        low = self.__cell_of(boxes[:, :2])
+        high = self.__cell_of(boxes[:, 2:])
+        span = (high - low + 1).max(axis=0, initial=1)
+
+        # Every cell inside each box, padded with the empty cell for smaller boxes
+        offset_x, offset_y = (i.ravel() for i in np.meshgrid(np.arange(span[0]), np.arange(span[1])))
+        cell_x = low[:, 0, np.newaxis] + offset_x
+        cell_y = low[:, 1, np.newaxis] + offset_y
+        in_box = (cell_x <= high[:, 0, np.newaxis]) & (cell_y <= high[:, 1, np.newaxis])
+        cells = np.where(in_box, cell_y * self.shape[0] + cell_x, self.empty_cell)
+
+        return self.__gather(cells).reshape(len(boxes), -1)
+
+    # Returns the segments that touch each box as an (N, K) array of segment indices, padded with
+    # -1. Boxes are (x_min, y_min, x_max, y_max). Only segments in cells the box overlaps are tested.
+    def box_hits(self, boxes:np.ndarray) -> np.ndarray:
+        segment_ids = self.__box_candidates(boxes)
+        hit = segments_hit_boxes(self.segments[segment_ids], boxes[:, np.newaxis, :]) & (segment_ids >= 0)
+        return np.where(hit, segment_ids, -1)
+
+    # Same as box_hits, but returns the segments in the grid that each of the given (N, 4)
+    # segments crosses. Only grid segments in cells the segment's bounding box overlaps are tested.
+    def segment_hits(self, segments:np.ndarray) -> np.ndarray:
+        boxes = np.column_stack((np.minimum(segments[:, 0], segments[:, 2]), np.minimum(segments[:, 1], segments[:, 3]),
+                                 np.maximum(segments[:, 0], segments[:, 2]), np.maximum(segments[:, 1], segments[:, 3])))
+        segment_ids = self.__box_candidates(boxes)
+        hit = segments_cross(segments[:, np.newaxis, :], self.segments[segment_ids]) & (segment_ids >= 0)
+        return np.where(hit, segment_ids, -1)
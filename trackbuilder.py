@@ -1,17 +1,20 @@
 import pygame as pg
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+import numpy as np
 # Shapely is a library with a ton of very useful geometry tools
+import shapely
 from shapely.geometry import LineString, Point, JOIN_STYLE
 from shapely.ops import nearest_points
-import json
-from pathlib import Path
+from spatial import segments_cross
+from trackfile import TRACKS_FILE, append_tracks
+# The border and checkpoint code is shared with trackgen.py, which makes tracks without clicking
+from trackgen import BORDER_OFFSET, checkpoint_line, generate_offset_loop, make_loop
 
 GRAY = (50, 50, 50)
 WHITE = (255, 255, 255)
 RED = (255, 0, 0)
 GREEN = (0, 255, 0)
 LINE_WIDTH = 3
-BORDER_OFFSET = 100
 
 def compute_point_loop(points:List[Tuple[float,float]]) -> List[Tuple[float,float]]:
     newpoints = [i for i in points]
@@ -25,16 +28,164 @@ def draw_point_loop(surface:pg.surface.Surface, points:List[Tuple[float,float]],
     for i in range(0, len(points) - 1):
         pg.draw.line(surface, color, points[i], points[i + 1], LINE_WIDTH)
 
-def generate_offset_loop(points:List[Tuple[float,float]],
-            offset:float) -> List[Tuple[float,float]]:
-    l_str = LineString(points)
-    o_str = l_str.offset_curve(offset, join_style=JOIN_STYLE.bevel)
-    return [i for i in o_str.coords]
+def as_segments(points:List[Tuple[float,float]]) -> np.ndarray:
+    points = np.array(points, dtype=float)
+    return np.hstack((points[:-1], points[1:]))
 
-def make_loop(line:LineString) -> LineString:
-    points = [i for i in line.coords]
-    points.append(points[0])
-    return LineString(points)
+# Returns the shortest distance between each segment in a and each segment in b. Both are (..., 4)
+# arrays that get broadcast together, same as segments_cross.
+def segment_distances(a:np.ndarray, b:np.ndarray) -> np.ndarray:
+    # If they don't cross, the closest they get is always at one of the four ends
+    def point_distances(points, starts, ends):
+        edge = ends - starts
+        length = (edge ** 2).sum(axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            along = np.clip(((points - starts) * edge).sum(axis=-1) / length, 0, 1)
+        along = np.where(length > 0, along, 0)
+        offset = points - (starts + edge * along[..., np.newaxis])
+        return np.hypot(offset[..., 0], offset[..., 1])
+
+    distances = np.minimum.reduce([
+        point_distances(a[..., :2], b[..., :2], b[..., 2:]),
+        point_distances(a[..., 2:], b[..., :2], b[..., 2:]),
+        point_distances(b[..., :2], a[..., :2], a[..., 2:]),
+        point_distances(b[..., 2:], a[..., :2], a[..., 2:]),
+    ])
+    return np.where(segments_cross(a, b), 0, distances)
+
+# Whether going from a to b and then to c turns all the way back along the same line
+def folds_back(a:Tuple[float,float], b:Tuple[float,float], c:Tuple[float,float]) -> bool:
+    cross = (b[0] - a[0]) * (c[1] - b[1]) - (b[1] - a[1]) * (c[0] - b[0])
+    dot = (b[0] - a[0]) * (c[0] - b[0]) + (b[1] - a[1]) * (c[1] - b[1])
+    return cross == 0 and dot < 0
+
+# Returns the points of a line as an array, and how far along the line each one is
+def line_points(line:LineString) -> Tuple[np.ndarray, np.ndarray]:
+    coords = shapely.get_coordinates(line)
+    steps = np.diff(coords, axis=0)
+    return (coords, np.concatenate(([0], np.cumsum(np.hypot(steps[:, 0], steps[:, 1])))))
+
+# Returns the points of a line that are between two distances along it (see line_points)
+def cut_line(coords:np.ndarray, lengths:np.ndarray, start:float, end:float) -> np.ndarray:
+    first = np.searchsorted(lengths, start, side="right")
+    last = np.searchsorted(lengths, end, side="left")
+    return coords[first:last]
+
+
+# Everything about the corners that have already been placed, so that while the mouse is being
+# moved around only the part of the track next to it has to be redone. Only the two segments
+# going to and from the mouse change, so the borders can only change where those segments get
+# close enough to cut them off (BORDER_OFFSET, the width of the track). Everything else gets
+# taken straight from the borders of the placed corners, which only get offset once per click.
+# Rebuilt whenever a corner is added or removed.
+class TrackEdit:
+    def __init__(self, points:List[Tuple[float,float]]) -> None:
+        self.points = list(points)
+        self.point_array = np.array(points, dtype=float)
+        self.midline = LineString(points)
+        self.segments = as_segments(points)
+        self.segment_low = np.minimum(self.segments[:, :2], self.segments[:, 2:])
+        self.segment_high = np.maximum(self.segments[:, :2], self.segments[:, 2:])
+        lengths = np.hypot(self.segments[:, 2] - self.segments[:, 0], self.segments[:, 3] - self.segments[:, 1])
+        self.distance_along = np.concatenate(([0], np.cumsum(lengths)))
+        self.borders = {}
+        for offset in (BORDER_OFFSET / 2, -BORDER_OFFSET / 2):
+            line = self.midline.offset_curve(offset, join_style=JOIN_STYLE.bevel)
+            if line.geom_type == "LineString":
+                coords, lengths = line_points(line)
+                closest = shapely.distance(self.midline, shapely.points(coords)).min()
+                self.borders[offset] = (line, coords, lengths, closest)
+
+    # The part of the track next to the mouse that has to be redone, as the first and last placed
+    # segments that keep their borders (first, last), and the corners the new border goes from and
+    # to (start, end). None if the track comes close to the mouse anywhere else, since then the
+    # borders there might change too.
+    def window(self, mouse:Tuple[float,float]) -> Optional[Tuple[int,int,int,int]]:
+        new_segments = as_segments([self.points[-1], mouse, self.points[0]])
+        # Segments whose bounding boxes aren't close enough can't be either
+        low = new_segments.reshape(-1, 2).min(axis=0) - BORDER_OFFSET - 1
+        high = new_segments.reshape(-1, 2).max(axis=0) + BORDER_OFFSET + 1
+        candidates = np.flatnonzero(((self.segment_high >= low) & (self.segment_low <= high)).all(axis=1))
+        near = np.zeros(len(self.segments), dtype=bool)
+        near[candidates] = (segment_distances(self.segments[candidates, np.newaxis], new_segments)
+                            < BORDER_OFFSET + 1).any(axis=1)
+        if near.all():
+            return None
+        first = int(np.argmin(near))
+        last = len(near) - 1 - int(np.argmin(near[::-1]))
+        if last <= first or near[first:last].any():
+            return None
+
+        # The new border also has to go far enough past those segments to include everything that
+        # could cut their borders off, so they come out exactly the same as they were
+        start = int(np.searchsorted(self.distance_along, self.distance_along[last] - BORDER_OFFSET / 2 - 1,
+                                    side="right")) - 1
+        end = int(np.searchsorted(self.distance_along, self.distance_along[first + 1] + BORDER_OFFSET / 2 + 1))
+        if start <= end or end >= len(self.points):
+            return None
+        return (first, last, start, end)
+
+    # Returns the border (going all the way around) with the mouse as the next corner, or None if
+    # it has to be computed the slow way (see window)
+    def border_loop(self, mouse:Tuple[float,float], window:Tuple[int,int,int,int],
+                offset:float) -> Optional[List[Tuple[float,float]]]:
+        if offset not in self.borders:
+            return None
+        line, coords, lengths, old_closest = self.borders[offset]
+        first, last, start, end = window
+        new_line = shapely.linestrings(np.concatenate((self.point_array[start:], [mouse],
+                                                       self.point_array[:end + 1]))).offset_curve(
+            offset, join_style=JOIN_STYLE.bevel)
+        if new_line.geom_type != "LineString":
+            return None
+
+        # Both borders get cut next to the middle of the first and last segments that stay the
+        # same, which is somewhere they both have to go through
+        cuts = []
+        for segment in self.segments[[last, first]]:
+            direction = segment[2:] - segment[:2]
+            if not direction.any():
+                return None
+            normal = np.array((-direction[1], direction[0])) / np.hypot(*direction)
+            cut = line.interpolate(line.project(Point((segment[:2] + segment[2:]) / 2 + normal * offset)))
+            if new_line.distance(cut) > 1e-6:
+                return None
+            cuts.append(cut)
+        cut_from, cut_to = cuts
+        new_from, new_to = new_line.project(cut_from), new_line.project(cut_to)
+        old_from, old_to = line.project(cut_to), line.project(cut_from)
+        if new_from >= new_to or old_from >= old_to:
+            return None
+        new_part = cut_line(*line_points(new_line), new_from, new_to)
+
+        # Corners that are too sharp for the border to fit around can leave loops in it that only
+        # get cleaned up when the whole border is done at once. They always end up closer to the
+        # middle of the track than the border should be. (Shapely leaves a few tiny ones in either
+        # way, so ones that are no worse than what's already in the old border don't count.)
+        new_points = shapely.points(new_part)
+        closest = np.minimum(shapely.distance(self.midline, new_points),
+                             shapely.distance(LineString([self.points[-1], mouse, self.points[0]]), new_points))
+        if (closest < min(abs(offset) - 1, old_closest)).any():
+            return None
+
+        cut_from, cut_to = [(cut_from.x, cut_from.y)], [(cut_to.x, cut_to.y)]
+        loop = np.concatenate((cut_to, cut_line(coords, lengths, old_from, old_to), cut_from, new_part, cut_to))
+        return [i for i in map(tuple, loop.tolist())]
+
+    # Whether the track would still be valid (not cross itself) with the mouse as the next corner.
+    # The placed corners can't cross each other, so only the two new segments have to be checked.
+    def valid(self, mouse:Tuple[float,float]) -> bool:
+        # The same corner twice in a row doesn't count as crossing, which the checks below can't tell
+        if mouse == self.points[-1] or mouse == self.points[0]:
+            return LineString(self.points + [mouse, self.points[0]]).is_simple
+        new_segments = as_segments([self.points[-1], mouse, self.points[0]])
+        crosses = segments_cross(new_segments[:, np.newaxis], self.segments)
+        # Each new segment always touches the placed segment it's connected to
+        crosses[0, -1] = False
+        crosses[1, 0] = False
+        return not (crosses.any() or folds_back(self.points[-2], self.points[-1], mouse)
+                    or folds_back(self.points[-1], mouse, self.points[0])
+                    or folds_back(mouse, self.points[0], self.points[1]))
 
 def write_json(borders:Tuple[Tuple[float,float]], start_point:Tuple[float, float],
         checkpoints:List[Tuple[Tuple[float,float]]], finish_line:Tuple[Tuple[float,float]], path:str) -> None:
@@ -45,13 +196,8 @@ def write_json(borders:Tuple[Tuple[float,float]], start_point:Tuple[float, float
         "checkpoints": checkpoints,
         "finish line": finish_line
     }
-    with open(Path(path), 'r') as tracks_raw:
-        tracks = json.load(tracks_raw)
-        tracks.append(track_data)
-
-    with open(Path(path), 'w') as tracks_raw:
-        json.dump(tracks, tracks_raw)
-        print("write successful")
+    append_tracks([track_data], path)
+    print("write successful")
 
 
 window = pg.display.set_mode((1080, 720))
@@ -80,6 +226,15 @@ preview_cp = ()
 # Used for testing if the track is valid (does not self-intersect)
 test_points = LineString()
 
+# Used for only redoing the part of the track next to the mouse (see TrackEdit)
+track_edit = None
+
+# Built once the track is finished, so finding the closest points
+# doesn't have to make new loops every time the mouse moves
+midline_ring = LineString()
+outer_ring = LineString()
+inner_ring = LineString()
+
 # Used when placing checkpoints and the starting point
 closest_midline_point = ()
 
@@ -114,21 +269,20 @@ while running:
                         inner_points = LineString(generate_offset_loop(temploop, -BORDER_OFFSET / 2))
                 # Remove the last point if right mouse is pressed
                 elif event.button == 3 and len(midline_point_loop) >= 1:
-                    if len(midline_point_loop) == 1:
-                        midline_point_loop = []
-                    else:
-                        midline_point_loop.pop(-1)
+                    midline_point_loop.pop(-1)
                     if len(midline_point_loop) > 1:
                         midline_points = LineString(midline_point_loop)
-                    if len(display_loop) > 3:
+                    if len(midline_display_loop) > 3:
                         temploop = midline_display_loop + midline_display_loop[:2]
                         outer_points = LineString(generate_offset_loop(temploop, BORDER_OFFSET / 2))
                         inner_points = LineString(generate_offset_loop(temploop, -BORDER_OFFSET / 2))
 
+                track_edit = TrackEdit(midline_point_loop) if len(midline_point_loop) >= 3 else None
                 display_loop = compute_point_loop(midline_point_loop)
                 update_display = True
             elif builder_state == "start point":
                 builder_state = "checkpoints"
+                update_display = True
             elif builder_state == "checkpoints":
                 checkpoints.append(preview_cp)
 
@@ -137,45 +291,55 @@ while running:
             if event.key == pg.K_RETURN:
                 if builder_state == "track":
                     builder_state = "start point"
+                    outer_display_loop = [i for i in outer_points.coords]
+                    inner_display_loop = [i for i in inner_points.coords]
+                    midline_ring = make_loop(midline_points)
+                    outer_ring = make_loop(outer_points)
+                    inner_ring = make_loop(inner_points)
                     update_display = True
                 elif builder_state == "checkpoints":
-                    start = Point(start_point)
-                    fp_point1 = nearest_points(make_loop(outer_points), start)[0]
-                    fp_point2 = nearest_points(make_loop(inner_points), start)[0]
-                    finish_line = ((fp_point1.x, fp_point1.y), (fp_point2.x, fp_point2.y))
+                    finish_line = checkpoint_line(start_point, outer_ring, inner_ring)
                     write_json((inner_display_loop[0:-1], outer_display_loop[0:-1]),
-                                start_point, checkpoints, finish_line, "data/tracks.json")
+                                start_point, checkpoints, finish_line, TRACKS_FILE)
                     running = False
 
     if update_display:
         if builder_state == "track":
             # Update display loops to add mouse position
             display_loop = compute_point_loop(midline_point_loop)
+            new_point = display_loop[-2]
             if len(display_loop) >= 2:
-                temploop = display_loop + display_loop[:2]
-                outer_display_loop = generate_offset_loop(temploop, BORDER_OFFSET / 2)
-                inner_display_loop = generate_offset_loop(temploop, -BORDER_OFFSET / 2)
+                edit_window = track_edit.window(new_point) if track_edit is not None else None
+                outer_display_loop = None
+                inner_display_loop = None
+                if edit_window is not None:
+                    outer_display_loop = track_edit.border_loop(new_point, edit_window, BORDER_OFFSET / 2)
+                    inner_display_loop = track_edit.border_loop(new_point, edit_window, -BORDER_OFFSET / 2)
 
-            if len(display_loop) > 3:
-                test_points = LineString(display_loop)
+                # Otherwise the whole border has to be redone
+                temploop = display_loop + display_loop[:2]
+                if outer_display_loop is None:
+                    outer_display_loop = generate_offset_loop(temploop, BORDER_OFFSET / 2)
+                if inner_display_loop is None:
+                    inner_display_loop = generate_offset_loop(temploop, -BORDER_OFFSET / 2)
 
             # Check if the track intersects itself
-            track_valid = test_points.is_simple
+            if track_edit is not None:
+                track_valid = track_edit.valid(new_point)
+            else:
+                if len(display_loop) > 3:
+                    test_points = LineString(display_loop)
+                track_valid = test_points.is_simple
         else:
-            outer_display_loop = [i for i in outer_points.coords]
-            inner_display_loop = [i for i in inner_points.coords]
-
             mp = Point(mouse_pos)
-            cmp = nearest_points(make_loop(midline_points), mp)[0]
+            cmp = nearest_points(midline_ring, mp)[0]
             closest_midline_point = (cmp.x, cmp.y)
         if builder_state == "start point":
             start_point = closest_midline_point
         elif builder_state == "checkpoints":
-            midpoint = Point(closest_midline_point)
-            cp_point1 = nearest_points(make_loop(outer_points), midpoint)[0]
-            cp_point2 = nearest_points(make_loop(inner_points), midpoint)[0]
-            preview_cp = ((cp_point1.x, cp_point1.y), (cp_point2.x, cp_point2.y))
-        
+            preview_cp = checkpoint_line(closest_midline_point, outer_ring, inner_ring)
+        update_display = False
+
     # Refresh the display
     window.fill(GRAY)
 
@@ -190,5 +354,3 @@ while running:
         pg.draw.line(window, RED, preview_cp[0], preview_cp[1], LINE_WIDTH)
     
     pg.display.flip()
-
-    moved = False
\ No newline at end of file
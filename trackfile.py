@@ -0,0 +1,271 @@
+# Compiled tracks: everything Track works out from a track in tracks.json (border segments, grids,
+# checkpoint order, etc.), saved in a binary file so it only ever has to be worked out once.
+# Loading one memory-maps the arrays instead of reading them in, so it's nearly instant, and every
+# process that loads the same track shares the same memory instead of each having a copy.
+#
+# Tracks get compiled automatically the first time they're used, but they can also be compiled
+# ahead of time with: python trackfile.py
+#
+# Tracks themselves are stored either in a .json file (a list of every track, like data/tracks.json),
+# or a .jsonl file (one track per line, like the ones trackgen.py makes). A .jsonl file only ever gets
+# added to, so saving a track doesn't mean reading and rewriting every track that's already in it.
+# TrackStore keeps an index of where each track starts in a .jsonl file, so training only ever reads
+# (and compiles) the tracks it actually uses, no matter how many are in the file.
+
+import json
+import os
+from collections import OrderedDict
+from hashlib import sha1
+from pathlib import Path
+from random import choice
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from track import Track, compile_track
+from settings import load_config
+
+TRACKS_FILE = Path(load_config().TRACKS.TRACKS_FILE)
+COMPILED_DIR = Path("data/compiled_tracks")
+# Changing how tracks get compiled means every compiled track has to be compiled again
+VERSION = 2
+# Changing what goes into a track file's index means it has to be made again
+INDEX_VERSION = 1
+
+# Reads every track in a .json or .jsonl file
+def read_tracks(tracks_file:Path=TRACKS_FILE) -> List[Dict]:
+    with open(tracks_file, 'r') as tracks_raw:
+        if Path(tracks_file).suffix != ".jsonl":
+            return json.load(tracks_raw)
+        lines = tracks_raw.read().split("\n")
+    # The last line is only finished once it ends with a newline, so one that got cut off partway
+    # through being written (if whatever was adding it crashed) just gets left out
+    return [json.loads(i) for i in lines[:-1] if i.strip()]
+
+# Adds tracks to the end of a .json or .jsonl file (making it if it doesn't exist yet). Adding to a
+# .json file means rewriting the whole thing, so big sets of tracks should go in a .jsonl file.
+def append_tracks(tracks:List[Dict], tracks_file:Path=TRACKS_FILE) -> None:
+    tracks_file = Path(tracks_file)
+    if tracks_file.parent != Path():
+        os.makedirs(tracks_file.parent, exist_ok=True)
+    if tracks_file.suffix == ".jsonl":
+        with open(tracks_file, 'a') as tracks_raw:
+            tracks_raw.write("".join(json.dumps(i) + "\n" for i in tracks))
+        return
+
+    existing = read_tracks(tracks_file) if tracks_file.exists() else []
+    with open(tracks_file, 'w') as tracks_raw:
+        json.dump(existing + list(tracks), tracks_raw)
+
+# Every track with the same points and grid size compiles to the same thing, so this is all
+# that goes into the file name.
+def track_key(track_data:Dict) -> str:
+    key = sha1(json.dumps(track_data, sort_keys=True).encode())
+    key.update(repr((load_config().TRACKS.GRID_CELL_SIZE, VERSION)).encode())
+    return key.hexdigest()
+
+# A compiled track is a single file: 8 bytes saying how long the header is, then the header (JSON
+# listing the name, type, shape and position of every array), then the arrays themselves. Every
+# array starts on a multiple of ALIGNMENT bytes, so they can all be used straight from the file.
+ALIGNMENT = 64
+
+def save_compiled(compiled:Dict[str, np.ndarray], path:Path) -> None:
+    arrays = {name: np.asarray(array, order="C") for name, array in compiled.items()}
+    header = {}
+    offset = 0
+    for name, array in arrays.items():
+        header[name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    # Everything gets written to a temporary file first, so other processes can never load a
+    # half-written track.
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(temp_path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(temp_path, path)
+
+# Memory-maps every array in a compiled track. They're read-only, since they're shared.
+def load_compiled(path:Path) -> Dict[str, np.ndarray]:
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    header_length = int.from_bytes(data[:8].tobytes(), "little")
+    header = json.loads(data[8:8 + header_length].tobytes())
+    data_start = -(-(8 + header_length) // ALIGNMENT) * ALIGNMENT
+    # np.asarray gets rid of the memmap wrapper (which slows down every operation on the
+    # array a little) but keeps the memory-mapped data underneath.
+    data = np.asarray(data[data_start:])
+
+    compiled = {}
+    for name, info in header.items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"], dtype=int))
+        compiled[name] = np.frombuffer(data, dtype, count, info["offset"]).reshape(tuple(info["shape"]))
+    return compiled
+
+# Returns the compiled version of a track's file, compiling it first if it hasn't been yet
+def compiled_track_path(track_data:Dict, compiled_dir:Path=COMPILED_DIR) -> Path:
+    path = Path(compiled_dir) / f"{track_key(track_data)}.track"
+    if not path.exists():
+        os.makedirs(compiled_dir, exist_ok=True)
+        save_compiled(compile_track(track_data), path)
+    return path
+
+# Compiles every track in TRACKS_FILE (if they aren't already), and returns their files
+def compile_tracks(tracks_file:Path=TRACKS_FILE, compiled_dir:Path=COMPILED_DIR) -> List[Path]:
+    return [compiled_track_path(i, compiled_dir) for i in read_tracks(tracks_file)]
+
+
+# Every track in a track file, where each one only gets read (and compiled) once it's actually
+# used. Tracks are numbered by where they are in the file, starting from 0. Tracks can also have
+# tags (see trackgen.py --tag), and ids and sample can be limited to the tracks with one of them.
+class TrackStore:
+    def __init__(self, tracks_file:Path=TRACKS_FILE, compiled_dir:Path=COMPILED_DIR) -> None:
+        self.tracks_file = Path(tracks_file)
+        self.compiled_dir = Path(compiled_dir)
+        # Compiled files that have been worked out so far, by track
+        self.paths = {}
+        # Every track's compiled file name, only worked out if find needs it
+        self.names = None
+        if self.tracks_file.suffix == ".jsonl":
+            self.tracks = None
+            self.starts, self.tags = self.load_index()
+        else:
+            # A .json file has to be read all at once anyway (they're only meant for a few tracks
+            # made by hand), so there's no index
+            self.tracks = read_tracks(self.tracks_file)
+            self.starts = None
+            self.tags = {}
+            for track_id, track_data in enumerate(self.tracks):
+                for tag in track_data.get("tags", ()):
+                    self.tags.setdefault(tag, []).append(track_id)
+
+    # The index is saved next to the track file (as "<file>.index"). It has where each track starts
+    # in the file, which tracks have each tag, and how much of the file it covers, so when tracks
+    # get added to the file only the new ones have to be read. Returns the starts and the tags.
+    def load_index(self) -> Tuple[np.ndarray, Dict[str, List[int]]]:
+        index_path = self.tracks_file.with_name(self.tracks_file.name + ".index")
+        starts = np.zeros(0, dtype=np.int64)
+        tags = {}
+        indexed = 0
+        last_line = sha1().hexdigest()
+        try:
+            with np.load(index_path) as index:
+                header = json.loads(index["header"].tobytes())
+                if header["version"] == INDEX_VERSION:
+                    starts = index["starts"]
+                    tags = header["tags"]
+                    indexed = header["size"]
+                    last_line = header["last_line"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with open(self.tracks_file, "rb") as tracks_raw:
+            # If the end of what got indexed isn't the same anymore, the file's been changed
+            # (instead of just added to) since then, so the whole thing has to be indexed again
+            line_start = int(starts[-1]) if len(starts) > 0 else 0
+            tracks_raw.seek(line_start)
+            if sha1(tracks_raw.read(indexed - line_start)).hexdigest() != last_line:
+                starts = np.zeros(0, dtype=np.int64)
+                tags = {}
+                indexed = 0
+            tracks_raw.seek(indexed)
+            added = tracks_raw.read()
+            # A last line without a newline is still being written (or got cut off), so it gets
+            # left for next time
+            added = added[:added.rfind(b"\n") + 1]
+            if not added:
+                return (starts, tags)
+
+            new_starts = []
+            position = indexed
+            for line in added.split(b"\n")[:-1]:
+                if line.strip():
+                    # Reading every track just to find the ones with tags would be slow
+                    if b'"tags"' in line:
+                        for tag in json.loads(line).get("tags", ()):
+                            tags.setdefault(tag, []).append(len(starts) + len(new_starts))
+                    new_starts.append(position)
+                position += len(line) + 1
+            starts = np.concatenate((starts, np.array(new_starts, dtype=np.int64)))
+            indexed = position
+            line_start = int(starts[-1]) if len(starts) > 0 else 0
+            tracks_raw.seek(line_start)
+            last_line = sha1(tracks_raw.read(indexed - line_start)).hexdigest()
+
+        header = {"version": INDEX_VERSION, "size": indexed, "last_line": last_line, "tags": tags}
+        temp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+        with open(temp_path, "wb") as f:
+            np.savez(f, starts=starts, header=np.frombuffer(json.dumps(header).encode(), dtype=np.uint8))
+        os.replace(temp_path, index_path)
+        return (starts, tags)
+
+    def __len__(self) -> int:
+        return len(self.tracks) if self.tracks is not None else len(self.starts)
+
+    # Reads a single track, in the same format as tracks.json
+    def track_data(self, track_id:int) -> Dict:
+        if self.tracks is not None:
+            return self.tracks[track_id]
+        with open(self.tracks_file, "rb") as tracks_raw:
+            tracks_raw.seek(int(self.starts[track_id]))
+            return json.loads(tracks_raw.readline())
+
+    # Returns a track's compiled file, compiling it first if it hasn't been yet
+    def path(self, track_id:int) -> Path:
+        if track_id not in self.paths:
+            self.paths[track_id] = compiled_track_path(self.track_data(track_id), self.compiled_dir)
+        return self.paths[track_id]
+
+    # Every track with a tag (or every track, if tag is None)
+    def ids(self, tag:Optional[str]=None) -> Sequence[int]:
+        if tag is None:
+            return range(len(self))
+        return self.tags.get(tag, [])
+
+    # Picks a random track (with a tag, if one is given) using Python's random module, the same way
+    # random.choice would pick from a list of every track
+    def sample(self, tag:Optional[str]=None) -> int:
+        ids = self.ids(tag)
+        if len(ids) == 0:
+            raise ValueError(f"There are no tracks{'' if tag is None else f' tagged {tag!r}'} in {self.tracks_file}")
+        return choice(ids)
+
+    # Finds which track a compiled file belongs to (or None if it isn't any of them). The first time
+    # a file that hasn't been worked out yet gets looked for, every track's compiled file name has to
+    # be worked out, but nothing gets compiled.
+    def find(self, path:Path) -> Optional[int]:
+        name = Path(path).name
+        for track_id, known in self.paths.items():
+            if known.name == name:
+                return track_id
+        if self.names is None:
+            tracks = self.tracks if self.tracks is not None else read_tracks(self.tracks_file)[:len(self)]
+            self.names = {f"{track_key(track_data)}.track": track_id for track_id, track_data in enumerate(tracks)}
+        return self.names.get(name)
+
+
+# Tracks that have already been loaded in this process, with the most recently used last. Tracks
+# never change during training, so the same Track gets reused instead of being set up again every
+# generation, but only the LOADED_TRACKS most recently used ones are kept.
+loaded_tracks = OrderedDict()
+
+# Returns the Track for a compiled track file, loading it if this process hasn't yet (or it's been
+# dropped since). A track is only ever drawn on the surface it was loaded with.
+def load_track(path:Path, surface=None, surface_size:Tuple[int,int]=(1080, 720)) -> Track:
+    path = str(path)
+    if path not in loaded_tracks:
+        loaded_tracks[path] = Track(surface, surface_size, load_compiled(path))
+    loaded_tracks.move_to_end(path)
+    limit = load_config().TRACKS.LOADED_TRACKS
+    while limit > 0 and len(loaded_tracks) > limit:
+        loaded_tracks.popitem(last=False)
+    return loaded_tracks[path]
+
+
+if __name__ == "__main__":
+    for i, path in enumerate(compile_tracks()):
+        print(f"Track {i}: {path}")
@@ -0,0 +1,193 @@
+# Makes random tracks without having to click them out by hand in trackbuilder, using the same
+# border and checkpoint code trackbuilder does, and adds them to the end of a .jsonl file (see
+# trackfile.py). Every track is made from its own seed, so the same seed always gives the same
+# tracks no matter how many processes they're split across.
+#
+#     python trackgen.py 1000                           adds 1000 tracks to data/generated_tracks.jsonl
+#     python trackgen.py 5000 --seed 7 --workers 0 --corners 6 14 --output data/curriculum.jsonl
+#     python trackgen.py 500 --corners 4 6 --tag easy
+#
+# To train on them, set TRACKS_FILE in config.txt to the file they were saved in (and TRACK_TAG to
+# only train on the ones with a tag).
+
+import argparse
+import multiprocessing as mp
+import os
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+# Shapely is a library with a ton of very useful geometry tools
+import shapely
+from shapely.geometry import LineString, LinearRing, Point, Polygon, JOIN_STYLE
+from shapely.ops import nearest_points
+from trackfile import append_tracks
+
+# Width of the track
+BORDER_OFFSET = 100
+# Tracks have to fit in the window
+TRACK_SIZE = (1080, 720)
+# Tracks get saved in batches of this many, so stopping partway through only loses the last batch
+BATCH_SIZE = 256
+
+def generate_offset_loop(points:List[Tuple[float,float]],
+            offset:float) -> List[Tuple[float,float]]:
+    l_str = LineString(points)
+    o_str = l_str.offset_curve(offset, join_style=JOIN_STYLE.bevel)
+    # Newer versions of Shapely can split the border into pieces where the loop goes over its
+    # first two points again, so then it gets offset as a closed loop instead
+    if o_str.geom_type != "LineString":
+        o_str = LinearRing(points[:-2]).offset_curve(offset, join_style=JOIN_STYLE.bevel)
+    if o_str.geom_type != "LineString":
+        o_str = max(o_str.geoms, key=lambda i: i.length)
+    return [i for i in o_str.coords]
+
+def make_loop(line:LineString) -> LineString:
+    points = [i for i in line.coords]
+    points.append(points[0])
+    return LineString(points)
+
+# The line across the track at a point on the midline, going to the closest point on each border
+# (which is how trackbuilder places checkpoints and the finish line)
+def checkpoint_line(point:Tuple[float,float], outer_ring:LineString,
+                    inner_ring:LineString) -> Tuple[Tuple[float,float],Tuple[float,float]]:
+    point = Point(point)
+    point1 = nearest_points(outer_ring, point)[0]
+    point2 = nearest_points(inner_ring, point)[0]
+    return ((point1.x, point1.y), (point2.x, point2.y))
+
+# Corners spread out around the middle of the window, at random distances from it. Going around
+# in order of angle means the midline can never cross itself.
+def random_corners(rng:np.random.Generator, corners:int) -> List[Tuple[float,float]]:
+    angles = (np.arange(corners) + rng.uniform(-0.35, 0.35, corners)) * 2 * np.pi / corners + rng.uniform(0, 2 * np.pi)
+    radii = rng.uniform(0.35, 1, (corners, 1)) * (np.array(TRACK_SIZE) / 2 - BORDER_OFFSET / 2 - 10)
+    points = np.array(TRACK_SIZE) / 2 + radii * np.column_stack((np.cos(angles), np.sin(angles)))
+    if rng.random() < 0.5:
+        points = points[::-1]
+    return [tuple(i) for i in points.tolist()]
+
+# Checks the same thing trackbuilder does (that the midline doesn't cross itself), plus everything a
+# person placing corners would've checked by eye: parts of the track that aren't next to each other
+# have to be at least a track's width apart (so the borders don't get merged together), and both
+# borders have to be single loops, one inside the other, that fit in the window.
+def valid_track(points:List[Tuple[float,float]], outer:List[Tuple[float,float]],
+                inner:List[Tuple[float,float]]) -> bool:
+    if not LineString(points + [points[0]]).is_simple:
+        return False
+
+    corners = np.array(points)
+    segments = shapely.linestrings(np.stack((corners, np.roll(corners, -1, axis=0)), axis=1))
+    distances = shapely.distance(segments[:, None], segments[None, :])
+    count = len(segments)
+    steps = np.abs(np.arange(count)[:, None] - np.arange(count)[None, :])
+    neighbours = np.minimum(steps, count - steps) <= 1
+    if (distances[~neighbours] < BORDER_OFFSET + 1).any():
+        return False
+
+    if len(outer) < 3 or len(inner) < 3:
+        return False
+    outer_ring = LinearRing(outer)
+    inner_ring = LinearRing(inner)
+    if not (outer_ring.is_simple and inner_ring.is_simple) or outer_ring.intersects(inner_ring):
+        return False
+    if not (Polygon(outer).contains(Polygon(inner)) or Polygon(inner).contains(Polygon(outer))):
+        return False
+    low = np.minimum(np.min(outer, axis=0), np.min(inner, axis=0))
+    high = np.maximum(np.max(outer, axis=0), np.max(inner, axis=0))
+    return bool((low >= 0).all() and (high <= TRACK_SIZE).all())
+
+# Makes track number "index" from a seed, in the same format trackbuilder saves them in. Checkpoints
+# are spread evenly around the track about "spacing" pixels apart, starting from a random start point.
+# Every tag in "tags" gets added to the track. Returns None if none of the attempts gave a valid track.
+def make_track(seed:int, index:int, corners:Tuple[int,int]=(6, 12), spacing:float=60,
+               tags:List[str]=(), attempts:int=100) -> Optional[Dict]:
+    rng = np.random.default_rng([seed, index])
+    for _ in range(attempts):
+        points = random_corners(rng, int(rng.integers(corners[0], corners[1] + 1)))
+        # Offset exactly the same way trackbuilder does once the track is finished
+        temploop = points + points[:2]
+        outer = generate_offset_loop(temploop, BORDER_OFFSET / 2)[0:-1]
+        inner = generate_offset_loop(temploop, -BORDER_OFFSET / 2)[0:-1]
+        if valid_track(points, outer, inner):
+            break
+    else:
+        return None
+
+    midline_ring = make_loop(LineString(points))
+    outer_ring = make_loop(LineString(outer))
+    inner_ring = make_loop(LineString(inner))
+    length = midline_ring.length
+    start = rng.uniform(0, length)
+    start_point = midline_ring.interpolate(start).coords[0]
+    count = max(int(length // spacing), 3)
+    # The first checkpoint is in front of the start point, so that's the way the cars face
+    checkpoints = [checkpoint_line(midline_ring.interpolate((start + length * i / count) % length).coords[0],
+                                   outer_ring, inner_ring) for i in range(1, count)]
+    track_data = {
+        "inner border": inner,
+        "outer border": outer,
+        "start point": start_point,
+        "checkpoints": checkpoints,
+        "finish line": checkpoint_line(start_point, outer_ring, inner_ring),
+    }
+    # Tags are only there for picking out tracks (see TrackStore in trackfile.py)
+    if tags:
+        track_data["tags"] = list(tags)
+    return track_data
+
+# Makes "count" tracks (numbered from "first") split across "workers" processes (0 uses every core),
+# and adds them to the end of "output". Returns how many were saved.
+def generate_tracks(count:int, output:Path, seed:int, first:int=0, workers:int=1, **options) -> int:
+    if workers <= 0:
+        workers = os.cpu_count()
+    make = partial(make_track, seed, **options)
+    indices = range(first, first + count)
+    pool = mp.Pool(workers) if workers > 1 else None
+    results = pool.imap(make, indices, chunksize=16) if pool is not None else map(make, indices)
+
+    saved = 0
+    batch = []
+    try:
+        for index, track in zip(indices, results):
+            if track is None:
+                print(f"Couldn't make track {index}, skipping it")
+                continue
+            batch.append(track)
+            if len(batch) == BATCH_SIZE:
+                append_tracks(batch, output)
+                saved += len(batch)
+                batch = []
+                print(f"{saved}/{count} tracks saved")
+        if batch:
+            append_tracks(batch, output)
+            saved += len(batch)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return saved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Makes random tracks and adds them to a track file.")
+    parser.add_argument("count", type=int, help="How many tracks to make.")
+    parser.add_argument("--output", type=Path, default=Path("data/generated_tracks.jsonl"),
+                        help="The file to add them to (a .jsonl file, see trackfile.py).")
+    parser.add_argument("--seed", type=int,
+                        help="Seed for the random numbers, so the same tracks can be made again (a random one if none is given).")
+    parser.add_argument("--first", type=int, default=0,
+                        help="Number of the first track to make, to add more tracks from the same seed to a file without repeating any.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to use (0 to use every core).")
+    parser.add_argument("--corners", type=int, nargs=2, default=(6, 12), metavar=("MIN", "MAX"),
+                        help="Range for how many corners each track has.")
+    parser.add_argument("--spacing", type=float, default=60, help="Roughly how far apart checkpoints are, in pixels.")
+    parser.add_argument("--tag", action="append", default=[], dest="tags",
+                        help="A tag to add to every track, so TRACK_TAG can pick them out (can be given more than once).")
+    args = parser.parse_args()
+    if args.corners[0] < 3 or args.corners[1] < args.corners[0]:
+        parser.error("Tracks need at least 3 corners, and MAX can't be less than MIN")
+
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy % 2**32)
+    print(f"Seed: {seed}")
+    saved = generate_tracks(args.count, args.output, seed, args.first, args.workers,
+                            corners=tuple(args.corners), spacing=args.spacing, tags=args.tags)
+    print(f"Added {saved} tracks to {args.output}")